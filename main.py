@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import json
 import sys
+import random
 import numpy as np
 import os.path
 import time
@@ -13,7 +14,7 @@ import argparse
 import nbt
 
 from util import blif, cell, cell_library
-from placer import placer
+from placer import placer, store, tempering, multilevel, checkpoint
 from router import router, extractor, minetime
 from vis import png
 from inserter import inserter
@@ -36,16 +37,28 @@ if __name__ == "__main__":
     parser.add_argument('--placements', metavar="placements_file", dest="placements_file", help="Use this placements file rather than creating one. Must be previously generated from the supplied BLIF.")
     parser.add_argument('--routings', metavar="routings_file", dest="routings_file", help="Use this routings file rather than creating one. Must be previously generated from the supplied BLIF and placements JSON.")
     parser.add_argument('--world', metavar="world_folder", dest="world_folder", help="Place the extracted redstone circuit layout in this world.")
+    parser.add_argument('--initial', dest="initial", choices=["grid", "analytical"], default="grid", help="How to generate the initial placement: a grid in BLIF order, or an analytical (quadratic wire length) placement.")
+    parser.add_argument('--iterations', metavar="N", dest="iterations", type=int, default=2000, help="Number of simulated annealing iterations.")
+    parser.add_argument('--schedule', dest="schedule", choices=["fixed", "adaptive"], default="fixed", help="Cooling schedule: a fixed geometric cooling, or an adaptive (Modified Lam) schedule driven by the acceptance rate.")
+    parser.add_argument('--patience', metavar="N", dest="patience", type=int, help="Stop annealing once the best score has not improved for this many iterations.")
+    parser.add_argument('--median-rate', metavar="fraction", dest="median_rate", type=float, default=0, help="Fraction of annealing moves that move a cell to the median of its nets.")
+    parser.add_argument('--orientation', dest="orientation", choices=["next", "best"], default="next", help="Whether reorientation moves turn a cell once, or pick its rotation with the shortest pin distances.")
+    parser.add_argument('--congestion', metavar="weight", dest="congestion", type=float, default=0, help="Weight of the routing congestion (RUDY) penalty in the placement score.")
+    parser.add_argument('--timing', metavar="weight", dest="timing", type=float, default=0, help="Weight the wire length of timing-critical nets by up to 1 + weight (timing-driven placement).")
+    parser.add_argument('--pins', dest="pins", choices=["declaration", "assignment"], default="declaration", help="How to place the circuit's pins: on the west and east rims in BLIF order, or on any rim by assignment to their nets' cells.")
+    parser.add_argument('--no-legalize', dest="legalize", action="store_false", help="Keep the annealed placement as it is, rather than removing overlaps and closing up gaps between cells.")
+    parser.add_argument('--multilevel', dest="multilevel", action="store_true", help="Anneal a clustered netlist first, then refine it level by level (for large netlists).")
+    parser.add_argument('--workers', metavar="N", dest="workers", type=int, default=1, help="Anneal placements with parallel tempering across this many processes.")
+    parser.add_argument('--replicas', metavar="N", dest="replicas", type=int, help="Number of parallel tempering replicas (defaults to the number of workers).")
+    parser.add_argument('--resume', dest="resume", action="store_true", help="Continue an interrupted simulated annealing run from the checkpoint in the output directory.")
+    parser.add_argument('--search', dest="search", choices=["lee", "astar"], default="lee", help="How the router searches for each wire segment's path: Lee's algorithm over the whole layout, or A* within a window around its pins.")
+    parser.add_argument('--negotiated', dest="negotiated", action="store_true", help="Route with negotiated congestion (PathFinder), re-routing every segment each iteration, instead of ripping up random segments.")
+    parser.add_argument('--route-workers', metavar="N", dest="route_workers", type=int, default=1, help="Re-route wire segments whose search windows don't overlap in parallel across this many processes.")
+    parser.add_argument('--steiner', dest="steiner", action="store_true", help="Connect the pins of each net with a rectilinear Steiner tree rather than a minimum spanning tree.")
+    parser.add_argument('--seed', metavar="seed", dest="seed", type=int, help="Seed the placer's random number generator, for reproducible runs.")
 
     args = parser.parse_args()
 
-    # Load placements, if provided
-    if args.placements_file is not None:
-        print("Using placements file:", args.placements_file)
-        with open(args.placements_file) as f:
-            placements = json.loads(f.readline())
-            dimensions = json.loads(f.readline())
-
     # Load library file
     with open(args.library_file) as f:
         cell_lib = cell_library.load(f)
@@ -74,16 +87,38 @@ if __name__ == "__main__":
 
     pregenerated_cells = cell_library.pregenerate_cells(cell_lib, pad=1)
 
+    # Load placements, if provided
+    if args.placements_file is not None:
+        print("Using placements file:", args.placements_file)
+        with open(args.placements_file) as f:
+            placements, dimensions = store.load(f, pregenerated_cells)
+
     placer = placer.GridPlacer(blif, pregenerated_cells, grid_spacing=5)
+    placer.median_rate = args.median_rate
+    placer.orientation = args.orientation
+    placer.congestion_weight = args.congestion
+    placer.timing_weight = args.timing
 
     start_time = time.time()
     print("Started", time.strftime("%c", time.localtime(start_time)))
 
     # PLACE =============================================================
     if placements is None:
-        underline_print("Performing Initial Placement...")
+        # Annealing state is saved here as it runs, to be resumed if interrupted
+        checkpoint_path = os.path.join(result_dir, "checkpoint.pickle")
+        resume = None
+
+        if args.resume:
+            print("Resuming from checkpoint:", checkpoint_path)
+            resume = checkpoint.load(checkpoint_path)
+            placements, dimensions = resume["placements"], resume["dimensions"]
+        else:
+            underline_print("Performing Initial Placement...")
 
-        placements, dimensions = placer.initial_placement()
+            if args.initial == "analytical":
+                placements, dimensions = placer.analytical_placement()
+            else:
+                placements, dimensions = placer.initial_placement()
 
         score = placer.score(placements, dimensions)
 
@@ -93,21 +128,45 @@ if __name__ == "__main__":
 
         # Place cells
         T_0 = 250
-        iterations = 2000
-        new_placements = placer.simulated_annealing_placement(placements, dimensions, T_0, iterations)
+        iterations = args.iterations
+        if args.seed is not None:
+            random.seed(args.seed)
+
+        if resume is not None:
+            new_placements = placer.simulated_annealing_placement(placements, dimensions, resume["T_0"],
+                resume["iterations"], resume["generations"], alpha=resume["alpha"], schedule=resume["schedule"],
+                patience=resume["patience"], checkpoint=checkpoint_path, resume=resume)
+        elif args.multilevel:
+            new_placements = multilevel.multilevel_placement(placer, placements, dimensions, T_0, iterations,
+                schedule=args.schedule, patience=args.patience)
+        elif args.workers > 1 or args.replicas is not None:
+            replicas = args.replicas if args.replicas is not None else args.workers
+            print("Parallel tempering with {} replicas on {} workers".format(replicas, args.workers))
+            new_placements = tempering.parallel_tempering_placement(placer, placements, dimensions, T_0,
+                replicas=replicas, workers=args.workers, seed=args.seed or 0, iterations=iterations)
+        else:
+            new_placements = placer.simulated_annealing_placement(placements, dimensions, T_0, iterations,
+                schedule=args.schedule, patience=args.patience, checkpoint=checkpoint_path)
+
+        if args.timing > 0:
+            print("Estimated critical path delay: {} ticks".format(placer.update_net_weights(new_placements)))
+
+        # Remove any remaining overlaps, and close up empty rows and columns
+        if args.legalize:
+            new_placements = placer.compact(placer.legalize(new_placements))
 
         placements, dimensions = placer.shrink(new_placements)
 
         # Place pins and resize
-        placements += placer.place_pins(dimensions)
+        placements += placer.place_pins(dimensions, placements, args.pins)
         placements, dimensions = placer.shrink(placements)
 
+        placements = store.PlacementStore.from_placements(placements, pregenerated_cells)
+
         # print(new_placements)
         print("Placed", len(placements), "cells")
         with open(os.path.join(result_dir, "placements.json"), "w") as f:
-            json.dump(placements, f)
-            f.write("\n")
-            json.dump(dimensions, f)
+            store.dump(placements, dimensions, f)
 
         # Visualize this layout
         layout = placer.placement_to_layout(dimensions, placements)
@@ -122,6 +181,9 @@ if __name__ == "__main__":
     layout = placer.placement_to_layout(dimensions, placements)
 
     router = router.Router(blif, pregenerated_cells)
+    router.search = args.search
+    router.workers = args.route_workers
+    router.steiner = args.steiner
 
     # Load routings, if provided
     if args.routings_file is not None:
@@ -134,7 +196,10 @@ if __name__ == "__main__":
         print("Doing initial routing...")
         routing = router.initial_routing(placements, blocks.shape)
         print("done.")
-        routing = router.re_route(routing, layout)
+        if args.negotiated:
+            routing = router.negotiated_route(routing, layout)
+        else:
+            routing = router.re_route(routing, layout)
 
         # Preserve routing
         with open(os.path.join(result_dir, "routing.json"), "w") as f:
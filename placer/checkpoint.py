@@ -0,0 +1,30 @@
+from __future__ import print_function
+
+import os
+import pickle
+import tempfile
+
+def save(checkpoint, path):
+    """
+    Write the checkpoint (a dictionary) to path atomically: it is written
+    to a temporary file in the same directory, which then replaces path,
+    so that an interrupted write never leaves a partial checkpoint.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".checkpoint")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def load(path):
+    """
+    Read a checkpoint written by save().
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,324 @@
+from __future__ import print_function
+
+from collections import defaultdict
+
+class IncrementalCost(object):
+    """
+    IncrementalCost tracks the placement cost that Placer.score() computes
+    (estimated wire length, overlap and out-of-bounds penalties), and
+    updates it as cells move instead of rescoring the whole placement.
+
+    It keeps, for each net, the coordinates of its pins, its bounding box
+    with the number of pins on each bound, and the box's length, and for
+    each location, the number of cells that occupy it. Moving a cell
+    therefore costs time proportional to the cell's footprint and number
+    of pins; a net's pins are only rescanned when the last pin on one of
+    its bounds moves inwards.
+
+    If the placer penalizes congestion, the routing demand map of
+    Placer.routing_demand() is kept too, along with the rectangle of bins
+    each net adds to it; only the bins under the moved nets' old and new
+    rectangles are rescored.
+
+    The placement is read from a PlacementStore, which the caller modifies
+    before calling update().
+
+    If count_overlap is False, the occupied locations are not tracked and
+    the overlap penalty is left at 0; callers that keep cells from
+    overlapping (see GridPlacementState) use this to make moves cheaper.
+    """
+    def __init__(self, placer, store, dimensions, count_overlap=True):
+        self.placer = placer
+        self.store = store
+        self.dimensions = dimensions
+        self.count_overlap = count_overlap
+
+        # (y, z, x) -> number of cells occupying that location
+        self.grid = defaultdict(int)
+
+        # net id -> {pin row: (y, z, x)}
+        self.net_pins = defaultdict(dict)
+        self.net_lengths = {}
+
+        # net id -> [mins, min counts, maxs, max counts], lists of the
+        # (y, z, x) bounds of its pins and how many pins lie on each, or
+        # None if it has no pins. A count of 0 marks a bound that is out
+        # of date until the net is rescanned.
+        self.net_boxes = {}
+
+        # cell index -> (anchor, shape)
+        self.cells = {}
+
+        self.wire_length = 0
+        self.overlap = 0
+        self.oob = 0
+
+        for i in xrange(len(store)):
+            self.add_cell(i)
+
+        # net id -> weight of its length (see Placer.net_weights)
+        self.net_weights = None
+        self.set_net_weights(placer.net_weights)
+
+        for net in self.net_pins:
+            self.net_lengths[net] = self.compute_net_length(net)
+            self.wire_length += self.net_weights[net] * self.net_lengths[net]
+
+        self.demand = None
+        self.congestion = 0
+        if placer.congestion_weight > 0:
+            self.demand = placer.routing_demand(store, dimensions)
+            self.congestion = placer.compute_congestion_penalty(self.demand)
+
+            # net id -> (z start, z stop, x start, x stop, density) of the
+            # bins it adds to the demand map
+            self.net_rects = {}
+            for net in self.net_pins:
+                self.net_rects[net] = self.compute_net_rect(net)
+
+    def set_net_weights(self, weights):
+        """
+        Set the weights of the nets' lengths from a dictionary of net names
+        to weights (None weights every net by 1), and recompute the wire
+        length.
+        """
+        weights = weights or {}
+        self.net_weights = [weights.get(name, 1) for name in self.store.net_names]
+        self.wire_length = sum(self.net_weights[net] * length for net, length in self.net_lengths.iteritems())
+
+    def total(self):
+        return self.wire_length + self.overlap + self.oob + self.congestion
+
+    def count_out_of_bounds(self, anchor, shape):
+        """
+        The number of locations of the box at anchor with the given shape
+        that lie outside the dimensions.
+        """
+        inside = 1
+        for start, size, bound in zip(anchor, shape, self.dimensions):
+            inside *= max(0, min(start + size, bound) - max(start, 0))
+        return shape[0] * shape[1] * shape[2] - inside
+
+    def compute_net_length(self, net):
+        """
+        Half-perimeter of the bounding box of the net's pins, as in
+        Placer.estimate_lengths_and_occupieds().
+        """
+        box = self.compute_net_box(net)
+        if box is None:
+            return 0
+
+        mins, maxs = box
+        return sum(maxs) - sum(mins)
+
+    def compute_net_box(self, net):
+        """
+        The (y, z, x) minimum and maximum corners of the net's pins, or None
+        if it has none.
+        """
+        box = self.net_boxes.get(net)
+        if box is None:
+            return None
+
+        mins, _, maxs, _ = box
+        return tuple(mins), tuple(maxs)
+
+    def scan_net_box(self, net):
+        """
+        Recompute the bounds of the net's pins, and how many pins lie on
+        each, from all of its pins.
+        """
+        pins = self.net_pins[net].values()
+        if len(pins) == 0:
+            self.net_boxes[net] = None
+            return
+
+        mins = [min(c[k] for c in pins) for k in xrange(3)]
+        maxs = [max(c[k] for c in pins) for k in xrange(3)]
+        min_counts = [sum(1 for c in pins if c[k] == mins[k]) for k in xrange(3)]
+        max_counts = [sum(1 for c in pins if c[k] == maxs[k]) for k in xrange(3)]
+        self.net_boxes[net] = [mins, min_counts, maxs, max_counts]
+
+    def add_pin(self, net, k, coord):
+        """
+        Add pin row k of the net at coord, widening the net's bounds.
+        """
+        self.net_pins[net][k] = coord
+
+        box = self.net_boxes.get(net)
+        if box is None:
+            self.net_boxes[net] = [list(coord), [1, 1, 1], list(coord), [1, 1, 1]]
+            return
+
+        # An out of date bound (count 0) lies beyond every remaining pin,
+        # so a pin at or beyond it becomes the bound
+        mins, min_counts, maxs, max_counts = box
+        for axis, c in enumerate(coord):
+            if c < mins[axis]:
+                mins[axis], min_counts[axis] = c, 1
+            elif c == mins[axis]:
+                min_counts[axis] += 1
+
+            if c > maxs[axis]:
+                maxs[axis], max_counts[axis] = c, 1
+            elif c == maxs[axis]:
+                max_counts[axis] += 1
+
+    def remove_pin(self, net, k):
+        """
+        Remove pin row k of the net. The bounds it was the last pin on are
+        left out of date, with a count of 0.
+        """
+        coord = self.net_pins[net].pop(k)
+
+        mins, min_counts, maxs, max_counts = self.net_boxes[net]
+        for axis, c in enumerate(coord):
+            if c == mins[axis]:
+                min_counts[axis] -= 1
+            if c == maxs[axis]:
+                max_counts[axis] -= 1
+
+    def compute_net_rect(self, net):
+        """
+        The bins of the demand map that the net covers, and the wire it adds
+        to each, as in Placer.routing_demand().
+        """
+        box = self.compute_net_box(net)
+        if box is None:
+            return None
+
+        (_, z_min, x_min), (_, z_max, x_max) = box
+        nbz, nbx = self.demand.shape
+        b = self.placer.congestion_bin_size
+
+        z0 = min(max(z_min // b, 0), nbz - 1)
+        z1 = min(max(z_max // b, 0), nbz - 1) + 1
+        x0 = min(max(x_min // b, 0), nbx - 1)
+        x1 = min(max(x_max // b, 0), nbx - 1) + 1
+
+        density = float(z_max - z_min + x_max - x_min) / ((z1 - z0) * (x1 - x0))
+        return (z0, z1, x0, x1, density)
+
+    def update_demand(self, nets):
+        """
+        Move the rectangles of the given nets in the demand map, and rescore
+        the bins under their old and new rectangles.
+        """
+        old_rects = [self.net_rects.get(net) for net in nets]
+        new_rects = [self.compute_net_rect(net) for net in nets]
+
+        rects = [r for r in old_rects + new_rects if r is not None]
+        if len(rects) == 0:
+            return
+
+        window = (slice(min(r[0] for r in rects), max(r[1] for r in rects)),
+                  slice(min(r[2] for r in rects), max(r[3] for r in rects)))
+
+        demand = self.demand
+        before = self.placer.compute_congestion_penalty(demand[window])
+
+        for rect in old_rects:
+            if rect is not None:
+                z0, z1, x0, x1, density = rect
+                demand[z0:z1, x0:x1] -= density
+
+        for net, rect in zip(nets, new_rects):
+            self.net_rects[net] = rect
+            if rect is not None:
+                z0, z1, x0, x1, density = rect
+                demand[z0:z1, x0:x1] += density
+
+        after = self.placer.compute_congestion_penalty(demand[window])
+        self.congestion += after - before
+
+    def cell_pins(self, i):
+        """
+        Returns the pin rows of cell i and the nets they connect to.
+        """
+        store = self.store
+        start, stop = store.pin_start[i:i+2].tolist()
+        return range(start, stop), store.pin_net[start:stop].tolist()
+
+    def add_cell(self, i):
+        """
+        Add the footprint and pins of the cell at index i.
+        """
+        store = self.store
+        t, r = store.type_ids[i], store.turns[i]
+        yy, zz, xx = store.coords[i].tolist()
+        height, width, length = store.shapes[t, r].tolist()
+
+        if self.count_overlap:
+            grid = self.grid
+            for y in xrange(yy, yy + height):
+                for z in xrange(zz, zz + width):
+                    for x in xrange(xx, xx + length):
+                        coord = (y, z, x)
+                        v = grid[coord]
+                        if v > 0:
+                            self.overlap += 1
+                        grid[coord] = v + 1
+
+        self.oob += self.count_out_of_bounds((yy, zz, xx), (height, width, length))
+
+        rows, nets = self.cell_pins(i)
+        offsets = store.port_offsets[t, r, store.pin_slot[rows]].tolist()
+        for k, net, (y, z, x) in zip(rows, nets, offsets):
+            self.add_pin(net, k, (y + yy, z + zz, x + xx))
+
+        self.cells[i] = ((yy, zz, xx), (height, width, length))
+
+    def remove_cell(self, i):
+        """
+        Remove the footprint and pins of the cell at index i, returning
+        the nets it was connected to.
+        """
+        (yy, zz, xx), (height, width, length) = self.cells.pop(i)
+
+        if self.count_overlap:
+            grid = self.grid
+            for y in xrange(yy, yy + height):
+                for z in xrange(zz, zz + width):
+                    for x in xrange(xx, xx + length):
+                        coord = (y, z, x)
+                        v = grid[coord] - 1
+                        if v > 0:
+                            self.overlap -= 1
+                        if v == 0:
+                            del grid[coord]
+                        else:
+                            grid[coord] = v
+
+        self.oob -= self.count_out_of_bounds((yy, zz, xx), (height, width, length))
+
+        rows, nets = self.cell_pins(i)
+        for k, net in zip(rows, nets):
+            self.remove_pin(net, k)
+
+        return nets
+
+    def update(self, indices):
+        """
+        Re-read the cells at the given indices from the store, and return
+        the new total cost.
+        """
+        touched = set()
+        for i in indices:
+            touched.update(self.remove_cell(i))
+        for i in indices:
+            self.add_cell(i)
+
+        for net in touched:
+            box = self.net_boxes[net]
+            if box is not None and (0 in box[1] or 0 in box[3]):
+                self.scan_net_box(net)
+
+            old_length = self.net_lengths.get(net, 0)
+            new_length = self.compute_net_length(net)
+            self.net_lengths[net] = new_length
+            self.wire_length += self.net_weights[net] * (new_length - old_length)
+
+        if self.demand is not None:
+            self.update_demand(list(touched))
+
+        return self.total()
@@ -0,0 +1,278 @@
+from __future__ import print_function
+
+import copy
+import random
+import numpy as np
+
+from collections import defaultdict, Counter
+from math import ceil
+
+from util.cell import Cell
+from store import PlacementStore, as_store
+
+def connectivity(store, max_net_size=16):
+    """
+    Returns the weights of the edges between cells that share nets, as a
+    dict of dicts indexed by cell index. A net with p cells adds 1/(p-1)
+    to the edge between every pair of them; nets with more than
+    max_net_size cells (clocks, resets) are ignored.
+    """
+    nets = defaultdict(set)
+    for cell, net in zip(store.pin_cell.tolist(), store.pin_net.tolist()):
+        nets[net].add(cell)
+
+    weights = defaultdict(lambda: defaultdict(float))
+    for cells in nets.itervalues():
+        if not 2 <= len(cells) <= max_net_size:
+            continue
+
+        w = 1. / (len(cells) - 1)
+        for a in cells:
+            for b in cells:
+                if a != b:
+                    weights[a][b] += w
+
+    return weights
+
+def heavy_edge_matching(store, sizes, max_cluster_size=16, max_net_size=16):
+    """
+    Pair each cell, visited in random order, with the unmatched neighbour
+    it shares the heaviest edge with. Edge weights are divided by the
+    combined size of the pair, so that small clusters are merged first,
+    and pairs larger than max_cluster_size library cells are not formed.
+
+    sizes is the number of library cells in each cell of the store.
+    Returns a list of clusters, each a list of one or two cell indices.
+    """
+    weights = connectivity(store, max_net_size)
+
+    order = range(len(store))
+    random.shuffle(order)
+
+    matched = [False] * len(store)
+    clusters = []
+
+    for a in order:
+        if matched[a]:
+            continue
+        matched[a] = True
+
+        best, best_weight = None, 0
+        for b, w in weights[a].iteritems():
+            size = sizes[a] + sizes[b]
+            if matched[b] or size > max_cluster_size:
+                continue
+            if w / size > best_weight:
+                best, best_weight = b, w / size
+
+        if best is None:
+            clusters.append([a])
+        else:
+            matched[best] = True
+            clusters.append([a, best])
+
+    return clusters
+
+def cluster_cells(name, members, pregenerated_cells, pitch=1, axis=2):
+    """
+    Generate the four rotations of a rigid cell that holds the cells named
+    in members side by side along axis (1 for Z, 2 for X), each in an area
+    that is a multiple of pitch, so that members of a cluster on a grid of
+    that pitch land on the grid. Its ports are the members' ports, named
+    "<member index>/<pin>".
+
+    Each rotation is assembled from the same rotation of every member, so
+    that a member of a cluster placed with some turns is exactly the
+    member cell placed with those turns. Returns the four cells and, for
+    each rotation, the (y, z, x) offset of every member.
+    """
+    shapes = [pregenerated_cells[member][0].shape for member in members]
+
+    # The area of each member, rounded up to a multiple of pitch
+    areas = [[int(ceil(float(n) / pitch)) * pitch for n in shape] for shape in shapes]
+
+    corners = []
+    position = 0
+    for area in areas:
+        corner = [0, 0, 0]
+        corner[axis] = position
+        corners.append(corner)
+        position += area[axis]
+
+    height = max(shape[0] for shape in shapes)
+    width = max(corner[1] + area[1] for corner, area in zip(corners, areas))
+    length = max(corner[2] + area[2] for corner, area in zip(corners, areas))
+
+    # Label the area of each member, to find where it lands when rotated.
+    # Members are placed at the corner of their rotated areas, which stay
+    # on multiples of pitch.
+    labels = np.full((width, length), -1, dtype=np.int32)
+    for j, ((_, z, x), (_, w, l)) in enumerate(zip(corners, areas)):
+        labels[z:z+w, x:x+l] = j
+
+    cells = []
+    offsets = []
+    for r in xrange(4):
+        rotated = np.rot90(labels, r)
+        blocks = np.zeros((height,) + rotated.shape, dtype=np.uint8)
+        data = np.zeros_like(blocks)
+        ports = {}
+        rotation_offsets = []
+
+        for j, member in enumerate(members):
+            cell = pregenerated_cells[member][r]
+            zs, xs = np.nonzero(rotated == j)
+            z0, x0 = int(zs.min()), int(xs.min())
+
+            h, w, l = cell.shape
+            blocks[:h, z0:z0+w, x0:x0+l] = cell.blocks
+            data[:h, z0:z0+w, x0:x0+l] = cell.data
+
+            for pin, d in cell.ports.iteritems():
+                y, z, x = d["coordinates"]
+                port = dict(d)
+                port["coordinates"] = (y, z + z0, x + x0)
+                ports["{}/{}".format(j, pin)] = port
+
+            rotation_offsets.append((0, z0, x0))
+
+        # Trim the padding beyond the last member on either axis
+        z1 = max(z0 + pregenerated_cells[member][r].shape[1]
+                 for member, (_, z0, _) in zip(members, rotation_offsets))
+        x1 = max(x0 + pregenerated_cells[member][r].shape[2]
+                 for member, (_, _, x0) in zip(members, rotation_offsets))
+        blocks = blocks[:, :z1, :x1]
+        data = data[:, :z1, :x1]
+
+        mask = np.ones_like(blocks, dtype=np.bool)
+        cells.append(Cell(blocks, data, mask, name, ports, 0))
+        offsets.append(rotation_offsets)
+
+    return cells, offsets
+
+def coarsen(placements, sizes, pregenerated_cells, level, pitch=1, max_cluster_size=16):
+    """
+    Merge matched pairs of placements into cluster cells, which are added
+    to pregenerated_cells. Clusters are laid out along X on odd levels and
+    along Z on even ones, so that they stay roughly square.
+
+    A cluster starts at the location of its first member. Nets that only
+    connect cells within a cluster are dropped from its pins.
+
+    Returns the coarse placements, the clusters (lists of indices into
+    placements), the member offsets of each cluster cell (see
+    cluster_cells()) and the size of each coarse placement.
+    """
+    store = PlacementStore.from_placements(placements, pregenerated_cells)
+    clusters = heavy_edge_matching(store, sizes, max_cluster_size)
+
+    axis = 2 if level % 2 == 1 else 1
+    net_pins = Counter(net for placement in placements for net in placement["pins"].itervalues())
+
+    coarse_placements = []
+    offsets = {}
+    for members in clusters:
+        if len(members) == 1:
+            coarse_placements.append(placements[members[0]])
+            continue
+
+        name = "cluster{}_{}".format(level, len(coarse_placements))
+        member_names = [placements[m]["name"] for m in members]
+        pregenerated_cells[name], offsets[name] = cluster_cells(name, member_names,
+            pregenerated_cells, pitch, axis)
+
+        pins = {}
+        for j, m in enumerate(members):
+            for pin, net in placements[m]["pins"].iteritems():
+                pins["{}/{}".format(j, pin)] = net
+
+        cluster_pins = Counter(pins.itervalues())
+        pins = {pin: net for pin, net in pins.iteritems() if cluster_pins[net] < net_pins[net]}
+
+        coarse_placements.append({"name": name,
+                                  "placement": list(placements[members[0]]["placement"]),
+                                  "turns": 0,
+                                  "pins": pins})
+
+    coarse_sizes = [sum(sizes[m] for m in members) for members in clusters]
+
+    return coarse_placements, clusters, offsets, coarse_sizes
+
+def uncoarsen(coarse_placements, placements, clusters, offsets):
+    """
+    Place the members of every cluster where the cluster's placement puts
+    them. Returns a copy of placements with the new locations and turns.
+    """
+    new_placements = [None] * len(placements)
+
+    for coarse, members in zip(coarse_placements, clusters):
+        y, z, x = coarse["placement"]
+        turns = coarse["turns"]
+
+        if len(members) == 1:
+            member_offsets = [(0, 0, 0)]
+        else:
+            member_offsets = offsets[coarse["name"]][turns]
+
+        for m, (dy, dz, dx) in zip(members, member_offsets):
+            placement = dict(placements[m])
+            placement["placement"] = [y + dy, z + dz, x + dx]
+            placement["turns"] = turns
+            new_placements[m] = placement
+
+    return new_placements
+
+def multilevel_placement(placer, initial_placements, dimensions, T_0=250, iterations=2000, coarsest=64, max_cluster_size=16, refine_T=2, refine_iterations=200, schedule="fixed", patience=None, verbose=True):
+    """
+    Place a large netlist by annealing a clustered version of it.
+
+    The placement is coarsened level by level with heavy_edge_matching()
+    until it has at most coarsest clusters (or matching stops shrinking
+    it). The coarsest level is annealed with
+    placer.simulated_annealing_placement() (with the given schedule and
+    patience), and each level is then uncoarsened and refined with a
+    short annealing run of refine_iterations starting at refine_T.
+
+    Cluster cells are aligned to the placer's grid interval, if it has
+    one. Returns the placement of the original cells.
+    """
+    placements = as_store(initial_placements, placer.pregenerated_cells).to_placements()
+    sizes = [1] * len(placements)
+
+    # The cluster cells of every level are added to a copy of the library
+    coarse_placer = copy.copy(placer)
+    coarse_placer.pregenerated_cells = dict(placer.pregenerated_cells)
+    pitch = getattr(placer, "interval", 1)
+
+    levels = []
+    while len(placements) > coarsest:
+        coarse = coarsen(placements, sizes, coarse_placer.pregenerated_cells,
+            len(levels) + 1, pitch, max_cluster_size)
+        coarse_placements, clusters, offsets, coarse_sizes = coarse
+
+        # Stop once matching no longer shrinks the placement
+        if len(coarse_placements) > 0.9 * len(placements):
+            break
+
+        levels.append((placements, clusters, offsets))
+        placements, sizes = coarse_placements, coarse_sizes
+
+    if verbose:
+        print("Coarsened {} cells into {} clusters over {} levels".format(len(initial_placements),
+            len(placements), len(levels)))
+
+    placements = coarse_placer.simulated_annealing_placement(placements, dimensions, T_0,
+        iterations, schedule=schedule, patience=patience, verbose=verbose)
+
+    for level in reversed(xrange(len(levels))):
+        fine_placements, clusters, offsets = levels[level]
+        placements = uncoarsen(placements, fine_placements, clusters, offsets)
+
+        if verbose:
+            print("Refining level {} ({} cells)".format(level, len(placements)))
+
+        level_placer = placer if level == 0 else coarse_placer
+        placements = level_placer.simulated_annealing_placement(placements, dimensions, T_0,
+            refine_iterations, T=refine_T, verbose=verbose)
+
+    return placements
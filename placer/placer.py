@@ -3,24 +3,53 @@ from __future__ import print_function
 import sys
 import random
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.optimize import linear_sum_assignment
 
 from collections import defaultdict
-from copy import deepcopy
 from math import exp, log, sqrt, ceil
 
 from util.blocks import block_names
 from vis import png
+from state import PlacementState, GridPlacementState
+from store import as_store
+from timing import net_criticality
+import checkpoint as checkpoint_module
 
 class Placer(object):
     def __init__(self, blif, pregenerated_cells):
         self.blif = blif
         self.pregenerated_cells = pregenerated_cells
 
+        # The weight of the routing congestion penalty (0 disables it), the
+        # side of its square bins, and the blocks of wire that each block
+        # of area can route before it counts as congested
+        self.congestion_weight = 0
+        self.congestion_bin_size = 8
+        self.congestion_capacity = 0.5
+
+        # For timing-driven placement, the weight of a net's wire length is
+        # 1 + timing_weight * criticality ** criticality_exponent (see
+        # update_net_weights()), recomputed every timing_update_interval
+        # annealing iterations. net_weights maps net names to weights.
+        self.timing_weight = 0
+        self.criticality_exponent = 8
+        self.timing_update_interval = 100
+        self.net_weights = None
+
+        # The fraction of moves that move a cell to the median of its nets
+        # (see median_location()), and how reorientations pick the new
+        # rotation: "next" turns the cell once, "best" picks the rotation
+        # that brings its pins closest to their nets (see best_turns())
+        self.median_rate = 0
+        self.orientation = "next"
+
     def compute_max_cell_dimension(self):
         # Estimate the width by taking the maximum of X or Z of all cells
         # used in the layout
         cells = [a[0] for a in self.pregenerated_cells.itervalues()]
-        max_cell_widths = [max(cell.blocks.shape[1], cell.blocks.shape[2]) for cell in cells]
+        max_cell_widths = [max(cell.shape[1], cell.shape[2]) for cell in cells]
         max_cell_width = max(max_cell_widths)
 
         return max_cell_width
@@ -53,7 +82,7 @@ class Placer(object):
         # Generate the square root (to place them in a square as best as possible
         num_cells_side = int(ceil(sqrt(len(cells))))
 
-        max_height = max(cell.blocks.shape[0] for cell in cells)
+        max_height = max(cell.shape[0] for cell in cells)
 
         max_cell_width = self.compute_max_cell_dimension()
 
@@ -91,107 +120,279 @@ class Placer(object):
 
         return placements, dimensions
 
-    def locate_pins(self, placements, filter=None):
-        net_pins = defaultdict(list)
-        for placement in placements:
-            if filter is not None and not filter(placement):
+    def analytical_placement(self, dimensions=None, model="clique", interval=None):
+        """
+        Generate an initial placement that minimizes the squared wire length
+        of the nets, rather than laying cells out in BLIF order.
+
+        The nets of the BLIF's cells form a quadratic program, with each
+        net modeled either as a clique of its pins (model="clique") or as
+        a star around an extra free node (model="star"). Circuit inputs are
+        anchored on the west rim and outputs on the east rim, as in
+        place_pins(). The sparse systems for Z and X are solved, and the
+        cells are then legalized onto a square grid of slots interval
+        apart: they are split into rows by Z and each row is ordered by X,
+        so every cell gets its own slot while keeping its relative order.
+
+        If interval is not given, the spacing of initial_placement() is
+        used. The placement is returned as in initial_placement().
+        """
+        if model not in ["clique", "star"]:
+            raise ValueError("Model must be 'clique' or 'star'")
+
+        spacing = 5
+
+        blif_cells = self.blif.cells
+        cells = [self.pregenerated_cells[bc["name"]][0] for bc in blif_cells]
+        num_cells = len(cells)
+
+        max_cell_width = self.compute_max_cell_dimension()
+        if interval is None:
+            interval = max_cell_width + spacing
+
+        num_cells_side = int(ceil(sqrt(num_cells)))
+        side = num_cells_side * interval
+
+        if dimensions is None:
+            max_height = max(cell.shape[0] for cell in cells)
+            width_estimate = (num_cells * (max_cell_width + spacing))
+            dimensions = (max_height, width_estimate, width_estimate)
+
+            print("Estimating dimensions to be {}".format(dimensions))
+        else:
+            if len(dimensions) != 3:
+                raise ValueError("Dimensions ({}) is not a tuple of length 3".format(dimensions))
+
+        # Fixed (z, x) anchors for the circuit pins on the west and east rims
+        anchors = defaultdict(list)
+        for nets, x in [(self.blif.inputs, -interval), (self.blif.outputs, side)]:
+            for i, net in enumerate(nets):
+                z = (i + 0.5) * side / len(nets)
+                anchors[net].append((z, x))
+
+        # The cells connected to each net
+        net_cells = defaultdict(set)
+        for i, blif_cell in enumerate(blif_cells):
+            for net in blif_cell["pins"].itervalues():
+                net_cells[net].add(i)
+
+        # Assemble the Laplacian of the connectivity graph (Q) and the pull
+        # of the anchors (b), so that the placement solves Q p = b
+        rows = []
+        cols = []
+        vals = []
+        b = defaultdict(lambda: np.zeros(2))
+        num_vars = num_cells
+
+        def connect(i, j, w):
+            rows.extend([i, j, i, j])
+            cols.extend([i, j, j, i])
+            vals.extend([w, w, -w, -w])
+
+        def anchor(i, coord, w):
+            rows.append(i)
+            cols.append(i)
+            vals.append(w)
+            b[i] += w * np.asarray(coord)
+
+        for net, members in net_cells.iteritems():
+            members = sorted(members)
+            fixed = anchors.get(net, [])
+            k = len(members) + len(fixed)
+            if k < 2:
                 continue
 
-            # Do the cell lookup
-            rotation = placement["turns"]
-            cell_name = placement["name"]
-            cell = self.pregenerated_cells[cell_name][rotation]
+            if model == "clique":
+                w = 1. / (k - 1)
+                for a, i in enumerate(members):
+                    for j in members[a+1:]:
+                        connect(i, j, w)
+                    for coord in fixed:
+                        anchor(i, coord, w)
+            else:
+                w = float(k) / (k - 1)
+                star = num_vars
+                num_vars += 1
+                for i in members:
+                    connect(i, star, w)
+                for coord in fixed:
+                    anchor(star, coord, w)
+
+        # Weakly pull everything to the center, so that groups of cells
+        # with no anchors still have a unique solution
+        center = (side / 2., side / 2.)
+        for i in xrange(num_vars):
+            anchor(i, center, 1e-6)
+
+        Q = scipy.sparse.coo_matrix((vals, (rows, cols)), shape=(num_vars, num_vars)).tocsc()
+        rhs = np.zeros((num_vars, 2))
+        for i, v in b.iteritems():
+            rhs[i] = v
+
+        solve = scipy.sparse.linalg.factorized(Q)
+        zs = solve(rhs[:, 0])[:num_cells]
+        xs = solve(rhs[:, 1])[:num_cells]
+
+        # Legalize: split into rows by Z, then order each row by X
+        slots = [None] * num_cells
+        by_z = np.argsort(zs, kind="mergesort")
+        for row in xrange(num_cells_side):
+            row_cells = by_z[row * num_cells_side:(row + 1) * num_cells_side]
+            by_x = row_cells[np.argsort(xs[row_cells], kind="mergesort")]
+            for col, i in enumerate(by_x):
+                slots[i] = (row, col)
 
-            yy, zz, xx = placement["placement"]
-            height, width, length = cell.blocks.shape
+        placements = []
+        for cell, blif_cell, (row, col) in zip(cells, blif_cells, slots):
+            placement = {"name": cell.name,
+                         "placement": [0, row * interval, col * interval],
+                         "turns": 0,
+                         "pins": blif_cell["pins"]}
+            placements.append(placement)
 
-            # Add the pins
-            for pin, d in cell.ports.iteritems():
-                (y, z, x) = d["coordinates"]
-                coord = (y + yy, z + zz, x + xx)
-                net_name = placement["pins"][pin]
-                net_pins[net_name].append(coord)
+        return placements, dimensions
 
-        return net_pins
+    def locate_pins(self, placements, cell_names=None):
+        """
+        Returns a dictionary of net names to the (y, z, x) coordinates of
+        their pins. If cell_names is given, only the pins of cells with
+        those names are located.
+        """
+        store = as_store(placements, self.pregenerated_cells)
 
-    def locate_circuit_pins(self, placements):
-        f = lambda x: x["name"] in ["input_pin", "output_pin"]
-        return self.locate_pins(placements, f)
+        coords = store.pin_coordinates()
+        nets = store.pin_net
+        if cell_names is not None:
+            mask = store.cells_named(cell_names)[store.pin_cell]
+            coords = coords[mask]
+            nets = nets[mask]
 
-    def estimate_lengths_and_occupieds(self, placements):
         net_pins = defaultdict(list)
-        grid = defaultdict(int)
+        for net, coord in zip(nets.tolist(), coords.tolist()):
+            net_pins[store.net_names[net]].append(tuple(coord))
 
-        for blif_cell, placement in zip(self.blif.cells, placements):
-            # Do the cell lookup
-            rotation = placement["turns"]
-            cell_name = placement["name"]
-            cell = self.pregenerated_cells[cell_name][rotation]
+        return net_pins
 
-            yy, zz, xx = placement["placement"]
-            height, width, length = cell.blocks.shape
+    def locate_circuit_pins(self, placements):
+        return self.locate_pins(placements, ["input_pin", "output_pin"])
 
-            # Add all items in this 3D matrix by the value 1
-            for y in xrange(height):
-                for z in xrange(width):
-                    for x in xrange(length):
-                        coord = (yy + y, zz + z, xx + x)
-                        grid[coord] += 1
+    def estimate_lengths_and_occupieds(self, placements):
+        """
+        Returns the half-perimeter length of every net's bounding box, and
+        the occupancy grid of the cells' bounding boxes.
+        """
+        store = as_store(placements, self.pregenerated_cells)
 
-            # Add the pins
-            for pin, d in cell.ports.iteritems():
-                (y, z, x) = d["coordinates"]
-                coord = (y + yy, z + zz, x + xx)
-                net_name = placement["pins"][pin]
-                net_pins[net_name].append(coord)
+        mins, maxs = self.net_bounding_boxes(store)
+        lengths = (maxs - mins).sum(axis=1)
+        net_lengths = dict(zip(store.net_names, lengths.tolist()))
 
-        net_lengths = {}
+        grid = self.occupancy_grid(store)
 
-        # Figure the point-to-point of these pins' locations
-        for net, pins in net_pins.iteritems():
-            dy = max(c[0] for c in pins) - min(c[0] for c in pins)
-            dz = max(c[1] for c in pins) - min(c[1] for c in pins)
-            dx = max(c[2] for c in pins) - min(c[2] for c in pins)
+        return net_lengths, grid
 
-            net_lengths[net] = dy + dz + dx
+    def net_bounding_boxes(self, placements):
+        """
+        Returns the (y, z, x) minimum and maximum corners of the bounding
+        box of every net's pins, as two arrays indexed by net id.
+        """
+        store = as_store(placements, self.pregenerated_cells)
 
-        # print(net_lengths)
+        coords = store.pin_coordinates()
+        num_nets = len(store.net_names)
+        mins = np.full((num_nets, 3), np.iinfo(np.int32).max, dtype=np.int32)
+        maxs = np.full((num_nets, 3), np.iinfo(np.int32).min, dtype=np.int32)
+        np.minimum.at(mins, store.pin_net, coords)
+        np.maximum.at(maxs, store.pin_net, coords)
 
-        return net_lengths, grid
+        return mins, maxs
 
+    def congestion_shape(self, dimensions):
+        """
+        The number of (Z, X) bins of the routing demand map.
+        """
+        b = self.congestion_bin_size
+        return (max(1, -(-dimensions[1] // b)), max(1, -(-dimensions[2] // b)))
 
-    def compute_occupied_locations(self, placements, dimensions):
+    def routing_demand(self, placements, dimensions):
+        """
+        Returns a RUDY (rectangular uniform wire density) map of the
+        routing demand: each net's half-perimeter wire length in Z and X is
+        spread evenly over the bins its bounding box covers, and the map
+        holds the blocks of wire expected in each bin. Boxes are clipped to
+        the bins within dimensions.
+        """
+        mins, maxs = self.net_bounding_boxes(placements)
+        has_pins = (maxs >= mins).all(axis=1)
+        mins, maxs = mins[has_pins], maxs[has_pins]
+
+        nbz, nbx = self.congestion_shape(dimensions)
+        b = self.congestion_bin_size
+        z0 = np.clip(mins[:, 1] // b, 0, nbz - 1)
+        z1 = np.clip(maxs[:, 1] // b, 0, nbz - 1) + 1
+        x0 = np.clip(mins[:, 2] // b, 0, nbx - 1)
+        x1 = np.clip(maxs[:, 2] // b, 0, nbx - 1) + 1
+
+        lengths = (maxs - mins)[:, 1:].sum(axis=1)
+        density = lengths / ((z1 - z0) * (x1 - x0)).astype(np.float64)
+
+        # Add each net's rectangle to a difference array, then integrate it
+        diff = np.zeros((nbz + 1, nbx + 1))
+        np.add.at(diff, (z0, x0), density)
+        np.add.at(diff, (z0, x1), -density)
+        np.add.at(diff, (z1, x0), -density)
+        np.add.at(diff, (z1, x1), density)
+
+        return diff.cumsum(axis=0).cumsum(axis=1)[:nbz, :nbx]
+
+    def compute_congestion_penalty(self, demand):
+        """
+        Penalize the demand of every bin in excess of its capacity.
+        """
+        capacity = self.congestion_capacity * self.congestion_bin_size ** 2
+        return self.congestion_weight * np.maximum(demand - capacity, 0).sum()
 
-        grid = defaultdict(int)
+    def occupancy_grid(self, placements, solid_only=False):
+        """
+        Returns a dense grid counting the number of cells that occupy each
+        location, as a (volume, origin) tuple, where volume[c - origin] is
+        the count at coordinate c. The volume is the bounding box of the
+        cells, so it also encloses cells that are out of bounds.
 
-        for placement in placements:
-            # Do the cell lookup
-            rotation = placement["turns"]
-            cell_name = placement["name"]
-            cell = self.pregenerated_cells[cell_name][rotation]
+        If solid_only is True, only the non-air blocks of each cell are
+        counted; otherwise, its whole bounding box is.
+        """
+        store = as_store(placements, self.pregenerated_cells)
+
+        min_corner, max_corner = store.bounding_box()
+        origin = np.array(min_corner)
 
-            yy, zz, xx = placement["placement"]
+        volume = np.zeros(np.subtract(max_corner, min_corner), dtype=np.int32)
 
-            for y in xrange(cell.blocks.shape[0]):
-                for z in xrange(cell.blocks.shape[1]):
-                    for x in xrange(cell.blocks.shape[2]):
-                        if cell.blocks[y, z, x] > 0:
-                            grid[(yy + y, zz + z, xx + x)] += 1
+        anchors = (store.coords - origin).tolist()
+        cells = zip(store.type_ids.tolist(), store.turns.tolist(), anchors)
+        for type_id, rotation, (y, z, x) in cells:
+            h, w, l = store.shapes[type_id, rotation]
+            if solid_only:
+                volume[y:y+h, z:z+w, x:x+l] += store.footprints[type_id][rotation]
+            else:
+                volume[y:y+h, z:z+w, x:x+l] += 1
 
-        # print(grid)
+        return volume, min_corner
 
-        return grid
+    def compute_occupied_locations(self, placements, dimensions):
+        return self.occupancy_grid(placements, solid_only=True)
 
     def compute_bounds_penalty(self, grid, dimensions):
-        penalty = 0
-        for coord, v in grid.iteritems():
-            y, z, x = coord
-            if y < 0 or y >= dimensions[0] or \
-               z < 0 or z >= dimensions[1] or \
-               x < 0 or x >= dimensions[2]:
-                penalty += v
+        """
+        Count the cells occupying each location outside of dimensions.
+        """
+        volume, origin = grid
 
-        return penalty
+        # The part of the volume within [0, dimensions)
+        inside = tuple(slice(max(-o, 0), max(d - o, 0)) for o, d in zip(origin, dimensions))
+
+        return int(volume.sum() - volume[inside].sum())
 
     def compute_overlap_penalty(self, grid):
         """
@@ -202,46 +403,155 @@ class Placer(object):
         However, if there is more than one cell, penalize by the amount in
         excess of one cell.
         """
+        volume, _ = grid
+
+        return int(np.maximum(volume - 1, 0).sum())
+
+    def create_state(self, placements, dimensions=None):
+        """
+        Returns the PlacementState that generate() modifies.
+        """
+        return PlacementState(self, placements, dimensions)
 
-        penalty = 0
-        for coord, v in grid.iteritems():
-            if v > 1:
-                penalty += (v - 1)
+    def displace_to(self, state, a, coord):
+        """
+        Move cell a to coord, returning the undo record.
+        """
+        return state.displace(a, coord)
+
+    def connected_boxes(self, state, a):
+        """
+        Returns the pin rows of cell a and, for each, the (y, z, x) minimum
+        and maximum corners of the other pins on its net (or None if there
+        are none), from the state's IncrementalCost.
+        """
+        cost = state.cost
+        rows, nets = cost.cell_pins(a)
+        own = set(rows)
+
+        boxes = []
+        for net in nets:
+            others = [c for row, c in cost.net_pins[net].iteritems() if row not in own]
+            if len(others) == 0:
+                boxes.append(None)
+            else:
+                mins = tuple(min(c[d] for c in others) for d in xrange(3))
+                maxs = tuple(max(c[d] for c in others) for d in xrange(3))
+                boxes.append((mins, maxs))
+
+        return rows, boxes
+
+    def median_location(self, state, a):
+        """
+        Returns the anchor that centers cell a on the median of the edges
+        of the bounding boxes of its nets' other pins, where the wire
+        length of its nets is smallest, or None if it is not connected.
+        """
+        _, boxes = self.connected_boxes(state, a)
+
+        zs = []
+        xs = []
+        for box in boxes:
+            if box is not None:
+                (_, z0, x0), (_, z1, x1) = box
+                zs += [z0, z1]
+                xs += [x0, x1]
+
+        if len(zs) == 0:
+            return None
 
-        return penalty
+        zs.sort()
+        xs.sort()
 
-    def generate(self, old_placements, T, T_0, dimensions, method="displace", displace_interchange_ratio=5):
+        store = state.store
+        y = store.coords[a, 0]
+        _, width, length = store.shapes[store.type_ids[a], store.turns[a]].tolist()
+        return [y, zs[len(zs) // 2] - width // 2, xs[len(xs) // 2] - length // 2]
+
+    def best_turns(self, state, a):
+        """
+        Returns the rotation of cell a (in place) that minimizes the total
+        distance from its pins to the bounding boxes of their nets' other
+        pins.
         """
-        Given an old placement, generate a new placement by either switching
-        the location of two cells or displacing a cell or rotating it.
+        rows, boxes = self.connected_boxes(state, a)
+
+        store = state.store
+        t = store.type_ids[a]
+        anchor = store.coords[a].tolist()
+        slots = store.pin_slot[rows].tolist()
+
+        best_distance, best = None, None
+        for r in xrange(4):
+            offsets = store.port_offsets[t, r, slots].tolist()
+            distance = 0
+            for offset, box in zip(offsets, boxes):
+                if box is None:
+                    continue
+                for c, o, lo, hi in zip(anchor, offset, box[0], box[1]):
+                    distance += max(lo - (c + o), 0, (c + o) - hi)
+
+            if best is None or distance < best_distance:
+                best_distance, best = distance, r
+
+        return best
+
+    def reorient_turns(self, state, a):
+        """
+        The rotation a reorientation of cell a moves it to, as chosen by
+        self.orientation.
+        """
+        if self.orientation == "best":
+            return self.best_turns(state, a)
+        elif self.orientation == "next":
+            return state.store.turns[a] + 1
+        else:
+            raise ValueError("Orientation must be 'next' or 'best'")
+
+    def generate(self, state, T, T_0, dimensions, method="displace", displace_interchange_ratio=5, window_scale=None):
+        """
+        Modify the placement state in place by either switching the location
+        of two cells or displacing a cell or rotating it.
 
         T is the current temperature; T_0 is the starting temperature. This
-        is used to scale the window for displacing a cell.
+        is used to scale the window for displacing a cell, unless
+        window_scale (between 0 and 1) is given.
 
         method can be "displace" or "reorient".
 
         displace_interchange_ratio is the ratio of how often you displace
-        a cell and how often you interchange it with another cell.
-        """
-        new_placements = deepcopy(old_placements)
+        a cell and how often you interchange it with another cell. A
+        fraction self.median_rate of moves are instead median moves (see
+        median_location()), and reorientations follow self.orientation.
 
+        Returns the undo record of the move and the method used.
+        """
         # Select a random cell to interchange, displace, or orient
-        cellA = random.choice(new_placements)
+        a = random.randrange(len(state))
+        store = state.store
+
+        # Move it toward its nets instead, some of the time
+        if self.median_rate > 0 and random.random() < self.median_rate:
+            target = self.median_location(state, a)
+            if target is not None:
+                return self.displace_to(state, a, target), "median"
 
         method_used = ""
 
         interchange = random.random() > (1. / displace_interchange_ratio)
         if interchange:
-            cellB = cellA
-            while cellB is cellA:
-                cellB = random.choice(new_placements)
+            b = a
+            while b == a:
+                b = random.randrange(len(state))
 
-            # print("Interchanging {} (at {}) with {} (at {})".format(cellA["name"], cellA["placement"], cellB["name"], cellB["placement"]))
-            cellA["placement"], cellB["placement"] = cellB["placement"], cellA["placement"]
+            undo = state.interchange(a, b)
             method_used = "interchange"
         else: # displace or reorient
             if method == "displace":
-                scaling_factor = log(T) / log(T_0)
+                if window_scale is None:
+                    scaling_factor = log(T) / log(T_0)
+                else:
+                    scaling_factor = window_scale
 
                 window_half_height = max(2, np.round(dimensions[1] * scaling_factor))
                 window_half_width = max(2, np.round(dimensions[2] * scaling_factor))
@@ -249,57 +559,129 @@ class Placer(object):
                 # print("Window width:", window_half_width * 2)
                 # print("Window height:", window_half_height * 2)
 
-                old_y, window_center_z, window_center_x = cellA["placement"]
+                old_y, window_center_z, window_center_x = store.coords[a].tolist()
 
                 # Select new X and Z from window
                 new_x = random.randint(window_center_x - window_half_width, window_center_x + window_half_width)
                 new_z = random.randint(window_center_z - window_half_height, window_center_z + window_half_height)
 
-                cellA["placement"] = [old_y, new_z, new_x]
+                undo = self.displace_to(state, a, [old_y, new_z, new_x])
                 method_used = "displace"
 
             elif method == "reorient":
-                # Rotate 90 degrees
-                cellA["turns"] = (cellA["turns"] + 1) % 4
+                undo = state.reorient(a, self.reorient_turns(state, a))
                 method_used = "reorient"
 
             else:
                 raise ValueError("Method must be 'displace' or 'reorient'")
 
-        return new_placements, method_used
+        return undo, method_used
+
+
+    def update_net_weights(self, placements):
+        """
+        Weight the wire length of each net by its timing criticality in
+        placements (see timing.net_criticality()). Returns the estimated
+        critical path delay, in ticks.
+        """
+        criticality, critical_delay = net_criticality(self, placements)
+
+        self.net_weights = {}
+        for net, crit in criticality.iteritems():
+            self.net_weights[net] = 1 + self.timing_weight * crit ** self.criticality_exponent
 
+        return critical_delay
 
     def score(self, placements, dimensions):
+        placements = as_store(placements, self.pregenerated_cells)
         estimated_net_lengths, occupied = self.estimate_lengths_and_occupieds(placements)
 
-        wire_length_penalty = sum(estimated_net_lengths.values())
+        if self.net_weights is not None:
+            weights = self.net_weights
+            wire_length_penalty = sum(weights.get(net, 1) * length for net, length in estimated_net_lengths.iteritems())
+        else:
+            wire_length_penalty = sum(estimated_net_lengths.values())
         overlap_penalty = self.compute_overlap_penalty(occupied)
         oob_penalty = self.compute_bounds_penalty(occupied, dimensions)
 
-        return wire_length_penalty + overlap_penalty + oob_penalty
+        score = wire_length_penalty + overlap_penalty + oob_penalty
+
+        if self.congestion_weight > 0:
+            demand = self.routing_demand(placements, dimensions)
+            score += self.compute_congestion_penalty(demand)
 
-    def last_consecutive(l, n):
+        return score
+
+    def last_consecutive(self, l, n):
+        """
+        Returns whether the last n elements of l are all equal.
+        """
         if len(l) < n:
             return False
-        for i in xrange(1,n-1):
-            if l[-i] != l[-i-1]:
-                return False
-        return True
+        return all(x == l[-1] for x in l[-n:])
+
+    def lam_target_acceptance(self, progress):
+        """
+        The target acceptance rate of the Modified Lam schedule, given the
+        fraction of moves made so far. It falls from 1 to 0.44 over the
+        first 15% of the moves, and then exponentially towards 0.001.
+
+        (The Modified Lam schedule holds the rate at 0.44 until 65% of the
+        moves; with the few thousand moves per cell that placement can
+        afford, that leaves too little time to cool.)
+        """
+        if progress < 0.15:
+            return 0.44 + 0.56 * 560 ** (-progress / 0.15)
+        else:
+            return 0.44 * 440 ** (-(progress - 0.15) / 0.85)
 
-    def simulated_annealing_placement(self, initial_placements, dimensions, T_0=500, iterations=2000, generations=20):
+    def simulated_annealing_placement(self, initial_placements, dimensions, T_0=500, iterations=2000, generations=20, T=None, alpha=0.9, verbose=True, schedule="fixed", patience=None, checkpoint=None, checkpoint_interval=50, resume=None, return_best=True):
         """
         Given an inital placement and initial temperature T_0, perform simulated
         annealing to find the placement with the lowest cost.
+
+        T is the temperature to start at, if other than T_0. (T_0 still
+        scales the window for displacing cells.) alpha is the multiplicative
+        factor 0 < alpha <= 1 that lowers the temperature after each
+        iteration; 1 anneals at a constant temperature.
+
+        schedule can be "fixed", which cools by alpha, or "adaptive", which
+        follows the Modified Lam schedule: after every move, the temperature
+        is lowered if the (smoothed) acceptance rate is above
+        lam_target_acceptance() and raised otherwise, and after every
+        iteration the displacement window grows or shrinks with the
+        acceptance rate.
+
+        If patience is given, annealing stops once the best score has not
+        improved for that many iterations (and, with the adaptive schedule,
+        fewer than 5% of moves are being accepted).
+
+        Statistics for each iteration (temperature, acceptance rate, mean
+        and best score, and window scale) are kept in self.annealing_stats.
+
+        If self.timing_weight is non-zero, nets are weighted by their
+        timing criticality (see update_net_weights()) at the start and
+        every self.timing_update_interval iterations.
+
+        If checkpoint (a path) is given, the annealer's state (the current
+        and best placements, temperature, iteration, random number
+        generator state and schedule statistics) is saved there every
+        checkpoint_interval iterations and when interrupted. To continue
+        from a checkpoint, pass it (see checkpoint.load()) as resume; its
+        placements take the place of initial_placements.
+
+        Returns the best placement found, or if return_best is False, the
+        placement annealing ended on (to continue the chain from, as
+        parallel tempering does).
         """
+        if schedule not in ["fixed", "adaptive"]:
+            raise ValueError("Schedule must be 'fixed' or 'adaptive'")
 
-        def update(T, alpha=lambda x: 0.9):
+        def update(T):
             """
             Give the new temperature based on T and alpha.
-
-            alpha is a function that produces a multiplicative factor 0 < a < 1
-            that gradually lowers the temperature.
             """
-            return T * alpha(T)
+            return T * alpha
 
         def accept(cost_new, cost_old, T):
             """
@@ -313,56 +695,183 @@ class Placer(object):
             acceptance_criterion = min(1, exp(ratio))
             return random.random() < acceptance_criterion
 
-        T = T_0
-        best_placements = initial_placements
-
-        prev_scores = []
+        if T is None:
+            T = T_0
+
+        if resume is not None:
+            initial_placements = resume["placements"]
+            self.net_weights = resume["net_weights"]
+        elif self.timing_weight > 0:
+            self.update_net_weights(initial_placements)
+
+        # Moves are applied to the state in place, and undone if rejected
+        state = self.create_state(initial_placements, dimensions)
+        old_score = state.score()
+
+        # Smoothed acceptance rate and window scale for the adaptive schedule.
+        # The per-move temperature step is sized so that a tenth of the
+        # moves can change the temperature by two orders of magnitude.
+        total_moves = float(iterations * generations)
+        acceptance_rate = 1.0
+        smoothing = min(0.1, 50. / total_moves)
+        lam_step = exp(log(1e2) / max(1, 0.1 * total_moves))
+        window_scale = 1.0 if schedule == "adaptive" else None
+
+        best_scores = []
+        best_score = old_score
+        best = (state.store.coords.copy(), state.store.turns.copy())
+        self.annealing_stats = []
         iteration = 0
 
+        if resume is not None:
+            T = resume["T"]
+            iteration = resume["iteration"]
+            acceptance_rate = resume["acceptance_rate"]
+            window_scale = resume["window_scale"]
+            best_scores = resume["best_scores"]
+            best_score = resume["best_score"]
+            best_store = as_store(resume["best_placements"], self.pregenerated_cells)
+            best = (best_store.coords, best_store.turns)
+            self.annealing_stats = resume["annealing_stats"]
+            random.setstate(resume["random_state"])
+
+        def save_checkpoint():
+            best_store = state.store.copy()
+            best_store.coords, best_store.turns = best
+            checkpoint_module.save({"placements": state.placements,
+                                    "dimensions": list(dimensions),
+                                    "T_0": T_0,
+                                    "T": T,
+                                    "alpha": alpha,
+                                    "iteration": iteration,
+                                    "iterations": iterations,
+                                    "generations": generations,
+                                    "schedule": schedule,
+                                    "patience": patience,
+                                    "acceptance_rate": acceptance_rate,
+                                    "window_scale": window_scale,
+                                    "best_scores": best_scores,
+                                    "best_score": best_score,
+                                    "best_placements": best_store.to_placements(),
+                                    "annealing_stats": self.annealing_stats,
+                                    "net_weights": self.net_weights,
+                                    "random_state": random.getstate()}, checkpoint)
+
+        # The placement as of the end of the last iteration, which a
+        # Ctrl-C part way through a move can't leave half-applied
+        consistent = (state.store.coords.copy(), state.store.turns.copy())
+
         try:
             prev_width = 0
             while iteration < iterations:
                 method = "displace"
+                accepted = 0
+                step_scores = 0
                 for generation in xrange(generations):
                     # print("  Generation", generation)
-                    new_placements, method_used = self.generate(best_placements, T, T_0, dimensions, method)
+                    undo, method_used = self.generate(state, T, T_0, dimensions, method, window_scale=window_scale)
 
-                    new_score = self.score(new_placements, dimensions)
-                    old_score = self.score(best_placements, dimensions)
+                    new_score = state.score()
+                    neutral = (new_score == old_score)
 
                     # Accept or reject this new placement
                     # If we rejected a "displace", do a reorientation next
-                    if accept(new_score, old_score, T):
-                        best_placements = new_placements
-                        taken_score = new_score
+                    was_accepted = accept(new_score, old_score, T)
+                    if was_accepted:
+                        old_score = new_score
+                        accepted += 1
                         if method_used == "reorient":
                             method = "displace"
                     else:
-                        taken_score = old_score
+                        state.undo(undo)
                         if method_used == "displace":
                             method = "reorient"
 
-                T = update(T)
-                prev_scores.append(taken_score)
+                    step_scores += old_score
+                    if old_score < best_score:
+                        best_score = old_score
+                        best = (state.store.coords.copy(), state.store.turns.copy())
+
+                    # Moves that leave the score unchanged are always
+                    # accepted, and say nothing about the temperature
+                    if schedule == "adaptive" and not neutral:
+                        acceptance_rate += smoothing * (was_accepted - acceptance_rate)
+                        progress = (iteration * generations + generation) / total_moves
+                        if acceptance_rate > self.lam_target_acceptance(progress):
+                            T /= lam_step
+                        else:
+                            T *= lam_step
+
+                step_acceptance = float(accepted) / generations
+                self.annealing_stats.append({"iteration": iteration,
+                                             "T": T,
+                                             "acceptance": step_acceptance,
+                                             "mean_score": float(step_scores) / generations,
+                                             "best_score": best_score,
+                                             "window_scale": window_scale})
+
+                taken_score = old_score
+                if schedule == "fixed":
+                    T = update(T)
+                else:
+                    window_scale = min(1.0, max(0.0, window_scale * (1 - 0.44 + acceptance_rate)))
+                best_scores.append(best_score)
+
+                # Reweight the nets by their criticality in the current
+                # placement, which rescales the score, and re-score the best
+                # placement under the new weights to compare it with the
+                # current one
+                if self.timing_weight > 0 and (iteration + 1) % self.timing_update_interval == 0:
+                    self.update_net_weights(state.store)
+                    state.cost.set_net_weights(self.net_weights)
+                    old_score = state.score()
+
+                    best_store = state.store.copy()
+                    best_store.coords, best_store.turns = best
+                    best_score = self.score(best_store, dimensions)
+                    if old_score <= best_score:
+                        best_score = old_score
+                        best = (state.store.coords.copy(), state.store.turns.copy())
 
                 # Print iteration and score
-                sys.stdout.write("\b" * prev_width)
-                msg = "Iteration: {}  Score: {}".format(iteration, taken_score)
-                sys.stdout.write(msg)
-                sys.stdout.flush()
-                prev_width = len(msg)
-
-                # if last_consecutive(prev_scores, 20):
-                #     break
+                if verbose:
+                    sys.stdout.write("\b" * prev_width)
+                    msg = "Iteration: {}  Score: {}  T: {:.3g}  Accepted: {:.0%}".format(iteration, taken_score, T, step_acceptance)
+                    sys.stdout.write(msg)
+                    sys.stdout.flush()
+                    prev_width = len(msg)
 
                 iteration += 1
+                consistent = (state.store.coords.copy(), state.store.turns.copy())
+
+                if checkpoint is not None and iteration % checkpoint_interval == 0:
+                    save_checkpoint()
+
+                # Stop once the best score has stopped improving (and, for
+                # the adaptive schedule, once it has cooled enough that few
+                # moves are accepted)
+                if patience is not None and self.last_consecutive(best_scores, patience + 1):
+                    if schedule == "fixed" or acceptance_rate < 0.05:
+                        break
 
         except KeyboardInterrupt:
-            pass
+            # Go back to the last consistent placement before saving it (the
+            # incremental cost is left stale, but is not used again)
+            state.store.coords, state.store.turns = consistent
+            if checkpoint is not None:
+                save_checkpoint()
+
+        if verbose:
+            print("\nPlacement complete")
 
-        print("\nPlacement complete")
+        if not return_best:
+            return state.placements
 
-        return best_placements
+        # Return the best placement seen, which the current one may have
+        # wandered away from
+        best_store = state.store.copy()
+        best_store.coords, best_store.turns = best
+        return best_store.to_placements()
 
     def placement_to_layout(self, dimensions, placements, min_y=5):
         """
@@ -374,14 +883,15 @@ class Placer(object):
         blocks = np.zeros((height, width, length), dtype=np.uint8)
         data   = np.zeros((height, width, length), dtype=np.uint8)
 
-        for placement in placements:
+        store = as_store(placements, self.pregenerated_cells)
+        cells = zip(store.type_ids.tolist(), store.turns.tolist(), store.coords.tolist())
+
+        for type_id, rotation, (y, z, x) in cells:
             # Do the cell lookup
-            rotation = placement["turns"]
-            cell_name = placement["name"]
+            cell_name = store.cell_types[type_id]
             cell = self.pregenerated_cells[cell_name][rotation]
 
-            y, z, x = placement["placement"]
-            height, width, length = cell.blocks.shape
+            height, width, length = cell.shape
 
             # Paste cell.blocks and cell.data into the layout
             blocks[y:y+height, z:z+width, x:x+length] = cell.blocks
@@ -389,60 +899,123 @@ class Placer(object):
 
         return (blocks, data)
 
+    def legalize(self, placements, spacing=5):
+        """
+        Returns a copy of the placements without overlapping cells, using
+        Tetris-style row legalization: cells are split into rows (Z bands
+        the largest cell dimension plus spacing apart), visited in order of
+        X, and each is placed in the row that displaces it least, spacing
+        to the right of the cells already in that row.
+        """
+        state = PlacementState(self, placements)
+        store = state.store
+        if len(store) == 0:
+            return state.placements
+
+        pitch = self.compute_max_cell_dimension() + spacing
+        coords = store.coords.tolist()
+        lengths = store.cell_shapes()[:, 2].tolist()
+
+        min_z = min(z for _, z, _ in coords)
+        max_z = max(z for _, z, _ in coords)
+        num_rows = (max_z - min_z) // pitch + 1
+        row_ends = [None] * num_rows
+
+        order = sorted(xrange(len(coords)), key=lambda i: (coords[i][2], coords[i][1]))
+        new_coords = [None] * len(coords)
+        for i in order:
+            y, z, x = coords[i]
+
+            best = None
+            for row in xrange(num_rows):
+                row_z = min_z + row * pitch
+                row_x = x if row_ends[row] is None else max(x, row_ends[row])
+                displacement = abs(row_z - z) + (row_x - x)
+                if best is None or displacement < best[0]:
+                    best = (displacement, row, row_z, row_x)
+
+            _, row, row_z, row_x = best
+            new_coords[i] = [y, row_z, row_x]
+            row_ends[row] = row_x + lengths[i] + spacing
+
+        state.apply(np.arange(len(store)), new_coords, store.turns)
+        return state.placements
+
+    def compact(self, placements, spacing=5):
+        """
+        Returns a copy of the placements with every gap between cells in Z
+        and in X that is wider than spacing closed up to spacing. Cells keep
+        their relative order, so no net gets longer.
+        """
+        state = PlacementState(self, placements)
+        store = state.store
+        if len(store) == 0:
+            return state.placements
+
+        coords = store.coords.copy()
+        shapes = store.cell_shapes()
+
+        for axis in [1, 2]:
+            starts = store.coords[:, axis]
+            stops = starts + shapes[:, axis]
+
+            # Merge the cells' extents along this axis, and find how far
+            # everything after each gap moves back
+            order = np.argsort(starts)
+            gap_ends = []
+            shifts = []
+            shift = 0
+            end = None
+            for start, stop in zip(starts[order].tolist(), stops[order].tolist()):
+                if end is not None and start - end > spacing:
+                    shift += start - end - spacing
+                    gap_ends.append(start)
+                    shifts.append(shift)
+                end = stop if end is None else max(end, stop)
+
+            if len(gap_ends) > 0:
+                k = np.searchsorted(gap_ends, starts, side="right")
+                coords[:, axis] -= np.concatenate([[0], shifts])[k]
+
+        state.apply(np.arange(len(store)), coords, store.turns)
+        return state.placements
+
     def shrink(self, placements):
         """
         Returns a copy of the placements with the smallest bounding box,
         and the dimensions of such.
         """
-        ys = []
-        zs = []
-        xs = []
+        state = PlacementState(self, placements)
 
-        placements = deepcopy(placements)
-
-        for placement in placements:
-            rotation = placement["turns"]
-            cell_name = placement["name"]
-            cell = self.pregenerated_cells[cell_name][rotation]
-
-            y, z, x = placement["placement"]
-            h, w, l = cell.blocks.shape
-
-            ys += [y, y+h]
-            zs += [z, z+w]
-            xs += [x, x+l]
-
-        min_y, max_y = min(ys), max(ys)
-        min_z, max_z = min(zs), max(zs)
-        min_x, max_x = min(xs), max(xs)
+        (min_y, min_z, min_x), (max_y, max_z, max_x) = state.bounding_box()
 
         dy = max_y - min_y + 1
         dz = max_z - min_z + 1
         dx = max_x - min_x + 1
 
-        for placement in placements:
-            y, z, x = placement["placement"]
-            placement["placement"] = [y - min_y, z - min_z, x - min_x]
+        state.translate((-min_y, -min_z, -min_x))
 
-        return placements, [dy, dz, dx]
+        return state.placements, [dy, dz, dx]
 
-    def place_pins(self, dimensions):
+    def place_pins(self, dimensions, placements=None, method="declaration", sides=None):
         """
-        Place pins around the west and east rims of the circuit.
+        Place pins around the rims of the circuit.
+
+        method can be "declaration", which places inputs down the west rim
+        and outputs down the east rim in BLIF order, or "assignment", which
+        assigns pins to the slots of the given sides (any of "west",
+        "east", "north" and "south"; all four by default) to minimize the
+        length of their nets in placements (see assign_pins()).
         """
-        def create_input_pin(net, coord):
-            input_pin = {"pins": {"Y": net},
-                         "turns": 0,
-                         "placement": coord,
-                         "name": "input_pin"}
-            return input_pin
+        if method not in ["declaration", "assignment"]:
+            raise ValueError("Method must be 'declaration' or 'assignment'")
 
-        def create_output_pin(net, coord):
-            output_pin = {"pins": {"A": net},
-                         "turns": 0,
-                         "placement": coord,
-                         "name": "output_pin"}
-            return output_pin
+        if method == "assignment":
+            if placements is None:
+                raise ValueError("Pin assignment needs the placements of the cells")
+            if sides is None:
+                sides = ["west", "east", "north", "south"]
+            return self.assign_pins(dimensions, placements, sides)
 
         input_nets = self.blif.inputs
         output_nets = self.blif.outputs
@@ -459,18 +1032,111 @@ class Placer(object):
         x = -margin
         for i, input_net_name in enumerate(input_nets):
             coord = [y, z + (pin_spacing * i), x]
-            pin_placements.append(create_input_pin(input_net_name, coord))
+            pin_placements.append(self.create_pin("input_pin", "Y", input_net_name, coord))
 
         # place output pins
         x = dimensions[2] + margin
         for i, output_net_name in enumerate(output_nets):
             coord = [y, z + (pin_spacing * i), x]
-            pin_placements.append(create_output_pin(output_net_name, coord))
+            pin_placements.append(self.create_pin("output_pin", "A", output_net_name, coord))
 
         # print("Placed", len(pin_placements), "pins")
 
         return pin_placements
 
+    def create_pin(self, name, pin, net, coord, turns=0):
+        return {"pins": {pin: net},
+                "turns": turns,
+                "placement": coord,
+                "name": name}
+
+    def pin_slots(self, dimensions, sides, count, margin=5, pin_spacing=5):
+        """
+        Returns the (y, z, x) slots for pins along the given sides of the
+        rim, pin_spacing apart and margin outside of dimensions, and the
+        direction (facing) a pin in each slot should face to point into the
+        circuit. Each side has enough slots to span its rim, and at least
+        count / len(sides) of them.
+        """
+        _, width, length = dimensions
+        per_side = int(ceil(float(count) / len(sides)))
+
+        inward = {"west": "east", "east": "west", "north": "south", "south": "north"}
+
+        slots = []
+        facings = []
+        for side in sides:
+            if side in ["west", "east"]:
+                n = max(per_side, width // pin_spacing + 1)
+                x = -margin if side == "west" else length + margin
+                slots += [[0, pin_spacing * i, x] for i in xrange(n)]
+            elif side in ["north", "south"]:
+                n = max(per_side, length // pin_spacing + 1)
+                z = -margin if side == "north" else width + margin
+                slots += [[0, z, pin_spacing * i] for i in xrange(n)]
+            else:
+                raise ValueError("Unknown side: {}".format(side))
+
+            facings += [inward[side]] * n
+
+        return slots, facings
+
+    def assign_pins(self, dimensions, placements, sides):
+        """
+        Assign the circuit's input and output pins to slots on the given
+        sides of the rim (see pin_slots()) by solving a linear assignment
+        problem. The cost of putting a pin in a slot is the half-perimeter
+        length its net would have, from the bounding box of the net's cell
+        pins and the pin's port in that slot (weighted by self.net_weights
+        if set). Pins are rotated to face into the circuit.
+        """
+        store = as_store(placements, self.pregenerated_cells)
+        mins, maxs = self.net_bounding_boxes(store)
+        net_ids = dict((net, i) for i, net in enumerate(store.net_names))
+        weights = self.net_weights or {}
+
+        pins = [("input_pin", "Y", net) for net in self.blif.inputs] + \
+               [("output_pin", "A", net) for net in self.blif.outputs]
+        if len(pins) == 0:
+            return []
+
+        slots, facings = self.pin_slots(dimensions, sides, len(pins))
+        slots = np.array(slots)
+
+        # The turns that point each pin into the circuit from each slot,
+        # and the location of its port there
+        facing_order = ["east", "north", "west", "south"]
+        port_coords = {}
+        slot_turns = {}
+        for name, pin, _ in pins:
+            if name in port_coords:
+                continue
+            base = self.pregenerated_cells[name][0].ports[pin]["facing"]
+            turns = [(facing_order.index(f) - facing_order.index(base)) % 4 for f in facings]
+            offsets = [self.pregenerated_cells[name][t].ports[pin]["coordinates"] for t in turns]
+            slot_turns[name] = turns
+            port_coords[name] = slots + np.array(offsets)
+
+        cost = np.zeros((len(pins), len(slots)))
+        for p, (name, _, net) in enumerate(pins):
+            i = net_ids.get(net)
+            if i is None or (maxs[i] < mins[i]).any():
+                continue
+
+            ports = port_coords[name]
+            box_min = np.minimum(ports, mins[i])
+            box_max = np.maximum(ports, maxs[i])
+            cost[p] = weights.get(net, 1) * (box_max - box_min).sum(axis=1)
+
+        rows, cols = linear_sum_assignment(cost)
+
+        pin_placements = []
+        for p, s in zip(rows.tolist(), cols.tolist()):
+            name, pin, net = pins[p]
+            pin_placements.append(self.create_pin(name, pin, net, slots[s].tolist(), slot_turns[name][s]))
+
+        return pin_placements
+
 class GridPlacer(Placer):
     """
     GridPlacer generates placements aligned on a grid with each location
@@ -486,66 +1152,163 @@ class GridPlacer(Placer):
         self.grid_width = self.compute_max_cell_dimension()
         self.interval = self.grid_spacing + self.grid_width
 
+    def analytical_placement(self, dimensions=None, model="clique"):
+        """
+        Generate an analytical initial placement (see
+        Placer.analytical_placement()) on this placer's grid.
+        """
+        return super(GridPlacer, self).analytical_placement(dimensions, model, self.interval)
+
+    def legalize(self, placements):
+        """
+        Returns a copy of the placements with every cell anchored in a slot
+        of its own. Cells are visited in order of X (Tetris-style), and each
+        takes the free slot nearest to its own.
+        """
+        state = PlacementState(self, placements)
+        store = state.store
+
+        interval = self.interval
+        coords = store.coords.tolist()
+        order = sorted(xrange(len(coords)), key=lambda i: (coords[i][2], coords[i][1]))
+
+        taken = set()
+        new_coords = [None] * len(coords)
+        for i in order:
+            y, z, x = coords[i]
+            slot_z, slot_x = z // interval, x // interval
+
+            # Search rings of slots at increasing Manhattan distance
+            slot = None
+            distance = 0
+            while slot is None:
+                for dz in xrange(-distance, distance + 1):
+                    dx = distance - abs(dz)
+                    for candidate in [(slot_z + dz, slot_x - dx), (slot_z + dz, slot_x + dx)]:
+                        if slot is None and candidate not in taken:
+                            slot = candidate
+                distance += 1
+
+            taken.add(slot)
+            new_coords[i] = [y, slot[0] * interval, slot[1] * interval]
+
+        if len(store) > 0:
+            state.apply(np.arange(len(store)), new_coords, store.turns)
+        return state.placements
+
+    def compact(self, placements):
+        """
+        Returns a copy of the placements with the empty rows and columns of
+        slots removed. Cells keep their relative order, so no net gets
+        longer.
+        """
+        state = PlacementState(self, placements)
+        store = state.store
+        if len(store) == 0:
+            return state.placements
+
+        coords = store.coords.copy()
+        for axis in [1, 2]:
+            slots = coords[:, axis] // self.interval
+            used, ranks = np.unique(slots, return_inverse=True)
+            offsets = coords[:, axis] - slots * self.interval
+            coords[:, axis] = (used[0] + ranks) * self.interval + offsets
+
+        state.apply(np.arange(len(store)), coords, store.turns)
+        return state.placements
+
     def snap_to_grid(self, coord):
         y, z, x = coord
         nz = int(round(z / self.interval) * self.interval)
         nx = int(round(x / self.interval) * self.interval)
         return (y, nz, nx)
 
-    def generate(self, old_placements, T, T_0, dimensions, method="displace", displace_interchange_ratio=5):
+    def create_state(self, placements, dimensions=None):
+        """
+        Returns a GridPlacementState on this placer's grid.
+        """
+        return GridPlacementState(self, placements, dimensions, self.interval)
+
+    def displace_to(self, state, a, coord):
         """
-        Given an old placement, generate a new placement by either switching
-        the location of two cells or displacing a cell or rotating it.
+        Move cell a to the slot containing coord if it is free, or else
+        interchange it with the cell in that slot. Returns the undo record.
+        """
+        y, z, x = coord
+        slot = (z // self.interval, x // self.interval)
+
+        others = [b for b in state.slot_cells.get(slot, ()) if b != a]
+        if len(others) > 0:
+            return state.interchange(a, min(others))
+
+        return state.displace(a, [y, slot[0] * self.interval, slot[1] * self.interval])
+
+    def generate(self, state, T, T_0, dimensions, method="displace", displace_interchange_ratio=5, window_scale=None):
+        """
+        Modify the placement state (a GridPlacementState) in place by either
+        switching the location of two cells or displacing a cell or rotating
+        it.
 
         T is the current temperature; T_0 is the starting temperature. This
-        is used to scale the window for displacing a cell.
+        is used to scale the window for displacing a cell, unless
+        window_scale (between 0 and 1) is given. A cell is only displaced
+        into a free slot; if the chosen slot is occupied, the cell is
+        interchanged with the cell in it instead.
 
         method can be "displace" or "reorient".
 
         displace_interchange_ratio is the ratio of how often you displace
-        a cell and how often you interchange it with another cell.
-        """
-        new_placements = deepcopy(old_placements)
+        a cell and how often you interchange it with another cell. A
+        fraction self.median_rate of moves are instead median moves (see
+        median_location()), and reorientations follow self.orientation.
 
+        Returns the undo record of the move and the method used.
+        """
         # Select a random cell to interchange, displace, or orient
-        cellA = random.choice(new_placements)
+        a = random.randrange(len(state))
+        store = state.store
+
+        # Move it toward its nets instead, some of the time
+        if self.median_rate > 0 and random.random() < self.median_rate:
+            target = self.median_location(state, a)
+            if target is not None:
+                return self.displace_to(state, a, target), "median"
 
         method_used = ""
 
         interchange = random.random() > (1. / displace_interchange_ratio)
         if interchange:
-            cellB = cellA
-            while cellB is cellA:
-                cellB = random.choice(new_placements)
+            b = a
+            while b == a:
+                b = random.randrange(len(state))
 
-            # print("Interchanging {} (at {}) with {} (at {})".format(cellA["name"], cellA["placement"], cellB["name"], cellB["placement"]))
-            cellA["placement"], cellB["placement"] = cellB["placement"], cellA["placement"]
+            undo = state.interchange(a, b)
             method_used = "interchange"
         else: # displace or reorient
             if method == "displace":
-                scaling_factor = log(T) / log(T_0)
+                if window_scale is None:
+                    scaling_factor = log(T) / log(T_0)
+                else:
+                    scaling_factor = window_scale
 
-                window_half_dim = max(1, round(10 * scaling_factor))
+                window_half_dim = int(max(1, round(10 * scaling_factor)))
 
-                old_y, window_center_z, window_center_x = cellA["placement"]
-
-                # Select new X and Z from window
-                dx = random.randint(-window_half_dim, window_half_dim) * self.interval
-                dz = random.randint(-window_half_dim, window_half_dim) * self.interval
+                old_y = store.coords[a, 0]
+                slot_z, slot_x = state.slot_of(a)
 
-                y, z, x = cellA["placement"]
+                # Select the new slot from the window
+                dz = random.randint(-window_half_dim, window_half_dim)
+                dx = random.randint(-window_half_dim, window_half_dim)
+                new_coord = [old_y, (slot_z + dz) * self.interval, (slot_x + dx) * self.interval]
 
-                new_coord = [old_y, z + dz, x + dx]
-                
-                cellA["placement"] = self.snap_to_grid(new_coord)
+                undo = self.displace_to(state, a, new_coord)
                 method_used = "displace"
 
             elif method == "reorient":
-                # Rotate 90 degrees
-                cellA["turns"] = (cellA["turns"] + 1) % 4
+                undo = state.reorient(a, self.reorient_turns(state, a))
                 method_used = "reorient"
 
             else:
                 raise ValueError("Method must be 'displace' or 'reorient'")
 
-        return new_placements, method_used
+        return undo, method_used
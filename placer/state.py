@@ -0,0 +1,170 @@
+from __future__ import print_function
+
+import numpy as np
+
+from cost import IncrementalCost
+from store import PlacementStore
+
+class PlacementState(object):
+    """
+    PlacementState is a mutable placement that moves are applied to in
+    place, rather than copying the whole placement for every proposal.
+    The cells are held in a PlacementStore.
+
+    Every move returns an undo record, an (indices, coords, turns) tuple
+    holding the previous values of the cells it changed. Passing the
+    record to undo() reverts the move.
+
+    If dimensions are given, the cost of the placement is tracked with an
+    IncrementalCost as moves are applied and undone.
+    """
+    def __init__(self, placer, placements, dimensions=None):
+        self.placer = placer
+        self.dimensions = dimensions
+
+        # Copy the placements once, so that the caller's are not modified
+        if isinstance(placements, PlacementStore):
+            self.store = placements.copy()
+        else:
+            self.store = PlacementStore.from_placements(placements, placer.pregenerated_cells)
+
+        if dimensions is not None:
+            self.cost = IncrementalCost(placer, self.store, dimensions)
+        else:
+            self.cost = None
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def placements(self):
+        """
+        The placement as a list of dictionaries.
+        """
+        return self.store.to_placements()
+
+    def score(self):
+        return self.cost.total()
+
+    def apply(self, indices, coords, turns):
+        """
+        Set the coords and turns of the cells at indices, and return the
+        undo record.
+        """
+        store = self.store
+        record = (indices, store.coords[indices].copy(), store.turns[indices].copy())
+        store.coords[indices] = coords
+        store.turns[indices] = turns
+
+        if self.cost is not None:
+            self.cost.update(indices)
+
+        return record
+
+    def undo(self, record):
+        """
+        Revert the move that produced the undo record.
+        """
+        self.apply(*record)
+
+    def interchange(self, a, b):
+        """
+        Swap the locations of cells a and b.
+        """
+        store = self.store
+        return self.apply([a, b], store.coords[[b, a]], store.turns[[a, b]])
+
+    def displace(self, a, coord):
+        """
+        Move cell a to coord.
+        """
+        return self.apply([a], [coord], self.store.turns[[a]])
+
+    def reorient(self, a, turns):
+        """
+        Rotate cell a to the given number of turns.
+        """
+        return self.apply([a], self.store.coords[[a]], [turns % 4])
+
+    def translate(self, offset):
+        """
+        Move every cell by offset, a (dy, dz, dx) tuple.
+        """
+        indices = np.arange(len(self.store))
+        return self.apply(indices, self.store.coords + offset, self.store.turns)
+
+    def bounding_box(self):
+        """
+        Returns the (y, z, x) minimum and maximum corners that enclose all
+        cells. The maximum corner is exclusive.
+        """
+        return self.store.bounding_box()
+
+class GridPlacementState(PlacementState):
+    """
+    GridPlacementState is a PlacementState whose cells sit in the slots of
+    a grid with the given interval, as GridPlacer places them. It indexes
+    which cells are in each (z, x) slot (a slot is free if it is not in
+    slot_cells), so that moves can target free slots.
+
+    If every cell is anchored at its own slot and fits within it in every
+    rotation, cells cannot overlap as long as moves keep it that way, and
+    the overlap penalty is not tracked.
+    """
+    def __init__(self, placer, placements, dimensions=None, interval=1):
+        super(GridPlacementState, self).__init__(placer, placements)
+        self.dimensions = dimensions
+        self.interval = interval
+
+        # (z slot, x slot) -> set of indices of the cells in that slot
+        self.slot_cells = {}
+        for i in xrange(len(self.store)):
+            self.add_to_slot(i)
+
+        if dimensions is not None:
+            self.cost = IncrementalCost(placer, self.store, dimensions,
+                count_overlap=self.cells_may_overlap())
+
+    def slot_of(self, i):
+        """
+        Returns the (z, x) slot of cell i.
+        """
+        _, z, x = self.store.coords[i].tolist()
+        return (z // self.interval, x // self.interval)
+
+    def add_to_slot(self, i):
+        self.slot_cells.setdefault(self.slot_of(i), set()).add(i)
+
+    def remove_from_slot(self, i):
+        slot = self.slot_of(i)
+        cells = self.slot_cells[slot]
+        cells.discard(i)
+        if len(cells) == 0:
+            del self.slot_cells[slot]
+
+    def cells_may_overlap(self):
+        """
+        Returns whether any cell is off its slot's anchor, shares its slot,
+        or is larger than a slot in some rotation.
+        """
+        store = self.store
+        if len(store) == 0:
+            return False
+
+        if store.shapes[store.type_ids][:, :, 1:].max() > self.interval:
+            return True
+        if (store.coords[:, 1:] % self.interval).any():
+            return True
+        return len(self.slot_cells) < len(store)
+
+    def apply(self, indices, coords, turns):
+        indices = [int(i) for i in indices]
+        for i in indices:
+            self.remove_from_slot(i)
+
+        record = super(GridPlacementState, self).apply(indices, coords, turns)
+
+        for i in indices:
+            self.add_to_slot(i)
+
+        return record
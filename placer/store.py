@@ -0,0 +1,229 @@
+from __future__ import print_function
+
+import json
+import numpy as np
+
+class PlacementStore(object):
+    """
+    PlacementStore holds a placement as parallel NumPy arrays instead of a
+    list of dictionaries:
+
+    - type_ids: the index of each cell's name in cell_types
+    - coords: the (y, z, x) anchor of each cell
+    - turns: the rotation (0-3) of each cell
+
+    Cell geometry is looked up in tables indexed by [type id, turns], and
+    every pin of every cell is listed in a pin table (pin_cell, pin_slot,
+    pin_net), ordered by cell, so that cell i owns the pin rows
+    pin_start[i] to pin_start[i+1].
+
+    Use from_placements() and to_placements() to convert to and from the
+    list of dictionaries that initial_placement() describes.
+    """
+    def __init__(self, pregenerated_cells, cell_types, type_ids, coords, turns, pin_slot, pin_net, net_names, pin_start, extra_pins=None):
+        self.pregenerated_cells = pregenerated_cells
+        self.cell_types = cell_types
+        self.type_ids = type_ids
+        self.coords = coords
+        self.turns = turns
+
+        self.pin_slot = pin_slot
+        self.pin_net = pin_net
+        self.net_names = net_names
+        self.pin_start = pin_start
+        self.pin_cell = np.repeat(np.arange(len(type_ids), dtype=np.int32), np.diff(pin_start))
+
+        # Pins in the placements that the cell has no port for
+        self.extra_pins = extra_pins if extra_pins is not None else {}
+
+        self.build_type_tables()
+
+    def build_type_tables(self):
+        """
+        Tabulate the shape, footprint, port offsets, port facings and port
+        directions of every rotation of every cell type, from the geometry
+        that each Cell precomputes.
+        """
+        num_types = len(self.cell_types)
+        rotations = [self.pregenerated_cells[name] for name in self.cell_types]
+
+        self.port_names = [cells[0].port_names for cells in rotations]
+
+        max_ports = max([len(names) for names in self.port_names] + [1])
+
+        self.shapes = np.zeros((num_types, 4, 3), dtype=np.int32)
+        self.port_offsets = np.zeros((num_types, 4, max_ports, 3), dtype=np.int32)
+        self.port_facings = np.zeros((num_types, 4, max_ports, 3), dtype=np.int32)
+        self.port_outputs = np.zeros((num_types, max_ports), dtype=np.bool)
+
+        # The non-air blocks of each rotation, indexed [type id][turns]
+        self.footprints = [[cell.footprint for cell in cells] for cells in rotations]
+
+        for t, cells in enumerate(rotations):
+            num_ports = len(self.port_names[t])
+            self.port_outputs[t, :num_ports] = cells[0].port_outputs
+            for r, cell in enumerate(cells):
+                self.shapes[t, r] = cell.shape
+                self.port_offsets[t, r, :num_ports] = cell.port_offsets
+                self.port_facings[t, r, :num_ports] = cell.port_facings
+
+    @classmethod
+    def from_placements(cls, placements, pregenerated_cells):
+        cell_types = []
+        type_index = {}
+        net_names = []
+        net_index = {}
+        port_slots = {}
+
+        n = len(placements)
+        type_ids = np.zeros(n, dtype=np.int16)
+        coords = np.zeros((n, 3), dtype=np.int32)
+        turns = np.zeros(n, dtype=np.int8)
+
+        pin_slot = []
+        pin_net = []
+        pin_start = [0]
+        extra_pins = {}
+
+        for i, placement in enumerate(placements):
+            name = placement["name"]
+            if name not in type_index:
+                type_index[name] = len(cell_types)
+                cell_types.append(name)
+
+            type_ids[i] = type_index[name]
+            coords[i] = placement["placement"]
+            turns[i] = placement["turns"]
+
+            if name not in port_slots:
+                port_names = pregenerated_cells[name][0].port_names
+                port_slots[name] = dict((pin, slot) for slot, pin in enumerate(port_names))
+            slots = port_slots[name]
+
+            for pin, net in placement["pins"].iteritems():
+                if pin not in slots:
+                    extra_pins.setdefault(i, {})[pin] = net
+                    continue
+
+                if net not in net_index:
+                    net_index[net] = len(net_names)
+                    net_names.append(net)
+
+                pin_slot.append(slots[pin])
+                pin_net.append(net_index[net])
+
+            pin_start.append(len(pin_slot))
+
+        return cls(pregenerated_cells, cell_types, type_ids, coords, turns,
+                   np.array(pin_slot, dtype=np.int16),
+                   np.array(pin_net, dtype=np.int32),
+                   net_names,
+                   np.array(pin_start, dtype=np.int32),
+                   extra_pins)
+
+    def to_placements(self):
+        placements = []
+        coords = self.coords.tolist()
+        turns = self.turns.tolist()
+        type_ids = self.type_ids.tolist()
+        pin_slot = self.pin_slot.tolist()
+        pin_net = self.pin_net.tolist()
+        pin_start = self.pin_start.tolist()
+
+        for i in xrange(len(self)):
+            t = type_ids[i]
+            ports = self.port_names[t]
+
+            pins = dict(self.extra_pins.get(i, {}))
+            for k in xrange(pin_start[i], pin_start[i+1]):
+                pins[ports[pin_slot[k]]] = self.net_names[pin_net[k]]
+
+            placement = {"name": self.cell_types[t],
+                         "placement": coords[i],
+                         "turns": turns[i],
+                         "pins": pins}
+            placements.append(placement)
+
+        return placements
+
+    def copy(self):
+        store = PlacementStore.__new__(PlacementStore)
+        store.__dict__.update(self.__dict__)
+        store.coords = self.coords.copy()
+        store.turns = self.turns.copy()
+        return store
+
+    def __len__(self):
+        return len(self.type_ids)
+
+    def cell_shapes(self):
+        """
+        Returns the (height, width, length) of every cell.
+        """
+        return self.shapes[self.type_ids, self.turns]
+
+    def pin_coordinates(self):
+        """
+        Returns the (y, z, x) coordinates of every row in the pin table.
+        """
+        cells = self.pin_cell
+        offsets = self.port_offsets[self.type_ids[cells], self.turns[cells], self.pin_slot]
+        return self.coords[cells] + offsets
+
+    def pin_facings(self):
+        """
+        Returns the (dy, dz, dx) direction that every pin faces.
+        """
+        cells = self.pin_cell
+        return self.port_facings[self.type_ids[cells], self.turns[cells], self.pin_slot]
+
+    def pin_outputs(self):
+        """
+        Returns whether every pin is an output.
+        """
+        return self.port_outputs[self.type_ids[self.pin_cell], self.pin_slot]
+
+    def pin_name(self, k):
+        return self.port_names[self.type_ids[self.pin_cell[k]]][self.pin_slot[k]]
+
+    def cells_named(self, names):
+        """
+        Returns a mask of the cells whose names are in names.
+        """
+        ids = [t for t, name in enumerate(self.cell_types) if name in names]
+        return np.in1d(self.type_ids, ids)
+
+    def bounding_box(self):
+        """
+        Returns the (y, z, x) minimum and maximum corners that enclose all
+        cells. The maximum corner is exclusive.
+        """
+        mins = self.coords.min(axis=0)
+        maxs = (self.coords + self.cell_shapes()).max(axis=0)
+        return tuple(mins.tolist()), tuple(maxs.tolist())
+
+def as_store(placements, pregenerated_cells):
+    """
+    Returns placements as a PlacementStore, converting it if it is a list
+    of placement dictionaries.
+    """
+    if isinstance(placements, PlacementStore):
+        return placements
+    return PlacementStore.from_placements(placements, pregenerated_cells)
+
+def load(f, pregenerated_cells):
+    """
+    Reads a placements file (the placements and the dimensions, each a line
+    of JSON) into a PlacementStore.
+    """
+    placements = json.loads(f.readline())
+    dimensions = json.loads(f.readline())
+    return PlacementStore.from_placements(placements, pregenerated_cells), dimensions
+
+def dump(store, dimensions, f):
+    """
+    Writes the PlacementStore and dimensions as a placements file.
+    """
+    json.dump(store.to_placements(), f)
+    f.write("\n")
+    json.dump(list(dimensions), f)
@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import sys
+import random
+import multiprocessing
+from math import exp
+
+# The placer and dimensions, set in each worker process by init_worker()
+worker_placer = None
+worker_dimensions = None
+
+def init_worker(placer, dimensions):
+    global worker_placer, worker_dimensions
+    worker_placer = placer
+    worker_dimensions = dimensions
+
+def anneal_replica(args):
+    """
+    Anneal one replica at a constant temperature, returning the placements
+    it ends on (not the best it passed through, so that the chain carries
+    on from where it was) and their score.
+    """
+    placements, T, T_0, iterations, generations, seed = args
+
+    random.seed(seed)
+    placements = worker_placer.simulated_annealing_placement(placements,
+        worker_dimensions, T_0, iterations, generations, T=T, alpha=1.0,
+        verbose=False, return_best=False)
+
+    return placements, worker_placer.score(placements, worker_dimensions)
+
+def temperature_ladder(T_max, T_min, replicas):
+    """
+    Geometrically spaced temperatures from T_max down to T_min.
+    """
+    if replicas == 1:
+        return [T_min]
+    ratio = (float(T_min) / T_max) ** (1. / (replicas - 1))
+    return [T_max * ratio ** i for i in xrange(replicas)]
+
+def parallel_tempering_placement(placer, initial_placements, dimensions, T_0=250, T_min=0.5, replicas=4, workers=None, seed=0, iterations=2000, exchange_interval=20, generations=20):
+    """
+    Perform simulated annealing with several replicas at different
+    temperatures (from T_0 down to T_min), each annealed in a process pool
+    with placer.simulated_annealing_placement().
+
+    Every exchange_interval iterations, replicas at adjacent temperatures
+    swap placements with the Metropolis probability
+    min(1, exp((E_i - E_j) * (1/T_i - 1/T_j))), so that good placements
+    found by hot replicas sink to the cold ones.
+
+    seed determines the seeds of every replica and exchange, so that a run
+    is reproducible regardless of the number of workers. Returns the best
+    placement seen.
+    """
+    temperatures = temperature_ladder(T_0, T_min, replicas)
+    rng = random.Random(seed)
+
+    score = placer.score(initial_placements, dimensions)
+    states = [(initial_placements, score) for _ in temperatures]
+    best_placements, best_score = initial_placements, score
+
+    if workers == 1:
+        init_worker(placer, dimensions)
+        pool = None
+        map_replicas = map
+    else:
+        pool = multiprocessing.Pool(workers, init_worker, (placer, dimensions))
+        map_replicas = pool.map
+
+    rounds = max(1, iterations // exchange_interval)
+
+    try:
+        prev_width = 0
+        for r in xrange(rounds):
+            jobs = []
+            for placements_score, T in zip(states, temperatures):
+                placements, _ = placements_score
+                job_seed = rng.randint(0, sys.maxint)
+                jobs.append((placements, T, T_0, exchange_interval, generations, job_seed))
+
+            states = map_replicas(anneal_replica, jobs)
+
+            for placements, score in states:
+                if score < best_score:
+                    best_placements, best_score = placements, score
+
+            # Attempt exchanges between adjacent temperatures, alternating
+            # between even and odd pairs
+            for i in xrange(r % 2, len(states) - 1, 2):
+                (_, E_i), (_, E_j) = states[i], states[i+1]
+                T_i, T_j = temperatures[i], temperatures[i+1]
+                ratio = (E_i - E_j) * (1. / T_i - 1. / T_j)
+                if ratio >= 0 or rng.random() < exp(ratio):
+                    states[i], states[i+1] = states[i+1], states[i]
+
+            sys.stdout.write("\b" * prev_width)
+            msg = "Round: {}  Scores: {}  Best: {}".format(r, [s for p, s in states], best_score)
+            sys.stdout.write(msg)
+            sys.stdout.flush()
+            prev_width = len(msg)
+
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+            pool = None
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print("\nPlacement complete")
+
+    return best_placements
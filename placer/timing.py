@@ -0,0 +1,123 @@
+from __future__ import print_function
+
+from collections import defaultdict, deque
+
+from router.minetime import MineTime
+from store import as_store
+
+# Cells whose inputs end timing paths and whose outputs start them, as in
+# MineTime.compute_combinational_delay()
+SEQUENTIAL_CELLS = ["DFF"]
+
+def timing_arcs(placer, placements):
+    """
+    Returns the timing arcs of the placement, as a list of (driver cell,
+    driven cell, net id, delay) tuples: one from the cell that drives
+    each net to every cell the net drives. The delay is the driver's
+    combinational delay plus the net delay that MineTime estimates from
+    the Manhattan distance between the two pins.
+    """
+    store = as_store(placements, placer.pregenerated_cells)
+    minetime = MineTime()
+
+    coords = store.pin_coordinates().tolist()
+    outputs = store.pin_outputs().tolist()
+    cells = store.pin_cell.tolist()
+    nets = store.pin_net.tolist()
+
+    cell_delays = []
+    for name in store.cell_types:
+        delay = placer.pregenerated_cells[name][0].delay or {}
+        cell_delays.append(delay.get("combinational", 0))
+    type_ids = store.type_ids.tolist()
+
+    drivers = defaultdict(list)
+    sinks = defaultdict(list)
+    for k, net in enumerate(nets):
+        if outputs[k]:
+            drivers[net].append(k)
+        else:
+            sinks[net].append(k)
+
+    arcs = []
+    for net, driver_rows in drivers.iteritems():
+        for d in driver_rows:
+            dy, dz, dx = coords[d]
+            cell_delay = cell_delays[type_ids[cells[d]]]
+            for s in sinks[net]:
+                sy, sz, sx = coords[s]
+                distance = abs(sz - dz) + abs(sx - dx)
+                delay = cell_delay + minetime.estimate_net_delay(distance, abs(sy - dy) // 3)
+                arcs.append((cells[d], cells[s], net, delay))
+
+    return arcs
+
+def net_criticality(placer, placements):
+    """
+    Estimate the criticality of every net with a longest-path pass over
+    timing_arcs(). Paths start at sequential cells and at cells with no
+    driven inputs, and end at sequential cells and at cells that drive
+    nothing.
+
+    The criticality of an arc is 1 - slack / D, where D is the critical
+    path delay, and the criticality of a net is that of its most critical
+    arc. Arcs in combinational loops are cut where the topological order
+    stops.
+
+    Returns a dictionary of net names to criticalities (between 0 and 1),
+    and D.
+    """
+    store = as_store(placements, placer.pregenerated_cells)
+    arcs = timing_arcs(placer, store)
+
+    # Arcs into sequential cells end at a separate node (n + cell), so
+    # that paths do not continue through them
+    n = len(store)
+    sequential = store.cells_named(SEQUENTIAL_CELLS).tolist()
+    out_arcs = defaultdict(list)
+    in_degree = defaultdict(int)
+    for u, v, net, delay in arcs:
+        if sequential[v]:
+            v += n
+        out_arcs[u].append((v, net, delay))
+        in_degree[v] += 1
+
+    # Topological order (Kahn's algorithm)
+    nodes = range(n) + [n + i for i in xrange(n) if sequential[i]]
+    queue = deque(node for node in nodes if in_degree[node] == 0)
+    order = []
+    while len(queue) > 0:
+        u = queue.popleft()
+        order.append(u)
+        for v, _, _ in out_arcs[u]:
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                queue.append(v)
+
+    # Nodes in combinational loops are visited last, in any order
+    if len(order) < len(nodes):
+        visited = set(order)
+        order += [node for node in nodes if node not in visited]
+
+    arrival = defaultdict(int)
+    for u in order:
+        for v, _, delay in out_arcs[u]:
+            arrival[v] = max(arrival[v], arrival[u] + delay)
+
+    critical_delay = max(arrival.values() + [0])
+
+    required = defaultdict(lambda: critical_delay)
+    for u in reversed(order):
+        for v, _, delay in out_arcs[u]:
+            required[u] = min(required[u], required[v] - delay)
+
+    criticality = defaultdict(float)
+    if critical_delay > 0:
+        for u in order:
+            for v, net, delay in out_arcs[u]:
+                slack = required[v] - arrival[u] - delay
+                crit = max(0., 1. - float(slack) / critical_delay)
+                criticality[net] = max(criticality[net], crit)
+
+    names = store.net_names
+    return dict((names[net], crit) for net, crit in criticality.iteritems()), critical_delay
@@ -42,11 +42,13 @@ class Extractor:
             def is_wire():
                 """
                 It's a wire if it moves in any of the compass directions and
-                the change in Y is no more than one.
+                the change in Y is no more than one, or if it doesn't move
+                (at a Steiner point, where the pin is on the wire itself).
                 """
                 return abs(y1 - y2) <= 1 and \
                     ((x1 == x2 and abs(z1 - z2) == 1) or \
-                     (z1 == z2 and abs(x1 - x2) == 1))
+                     (z1 == z2 and abs(x1 - x2) == 1) or \
+                     (y1 == y2 and z1 == z2 and x1 == x2))
 
             if is_wire():
                 return Extractor.WIRE
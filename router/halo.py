@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+import numpy as np
+
+# (dy, dz, dx) offsets from a piece of redstone wire to the locations it
+# may transmit to: its four neighbours, on its own level and one below
+HALO_OFFSETS = np.array([(dy, dz, dx) for dy in (0, -1)
+                                      for dz, dx in ((1, 0), (-1, 0), (0, 1), (0, -1))])
+
+def neighbours(coords, shape, offsets=HALO_OFFSETS):
+    """
+    Returns the locations at each of offsets from each of coords (an
+    (n, 3) array of (y, z, x) coordinates), dropping those outside of
+    shape. Locations reached from more than one coordinate appear more
+    than once.
+    """
+    coords = np.asarray(coords, dtype=np.int).reshape(-1, 1, 3)
+    result = (coords + offsets).reshape(-1, 3)
+    inside = np.all((result >= 0) & (result < np.array(shape)), axis=1)
+    return result[inside]
+
+def dilate(matrix, offsets=HALO_OFFSETS):
+    """
+    Returns, for every location p of matrix, the number of offsets o for
+    which matrix[p + o] is non-zero. Locations outside of the matrix are
+    empty.
+    """
+    height, width, length = matrix.shape
+    occupied = np.pad(matrix != 0, 1, "constant").astype(np.int8)
+
+    counts = np.zeros(matrix.shape, dtype=np.int8)
+    for dy, dz, dx in offsets.tolist():
+        counts += occupied[1+dy:1+dy+height, 1+dz:1+dz+width, 1+dx:1+dx+length]
+
+    return counts
+
+class HaloMap(object):
+    """
+    HaloMap holds, for every location in the layout, the number of
+    occupied locations that a redstone wire placed there would transmit
+    to. A wire can pass through the locations whose count is zero without
+    violating anything.
+
+    It is computed once from a usage matrix, then kept up to date as
+    locations become occupied or free.
+    """
+    def __init__(self, usage_matrix):
+        self.shape = usage_matrix.shape
+        self.counts = dilate(usage_matrix)
+
+    def update(self, coords, delta):
+        """
+        Add delta to the count of every location that sees one of coords.
+        """
+        # p sees q if q = p + o, so p = q - o
+        seen_from = neighbours(coords, self.shape, -HALO_OFFSETS)
+        np.add.at(self.counts, tuple(seen_from.T), delta)
+
+    def add(self, coords):
+        """
+        Mark the locations coords, which were free, as occupied.
+        """
+        self.update(coords, 1)
+
+    def remove(self, coords):
+        """
+        Mark the locations coords, which were occupied, as free.
+        """
+        self.update(coords, -1)
+
+    def exemptions(self, usage_matrix, coords):
+        """
+        Returns a dictionary of how many of the occupied locations among
+        coords each location sees, so that those can be discounted (e.g.,
+        the pins a wire is routed between).
+        """
+        exempt = {}
+        for coord in set(coords):
+            if usage_matrix[coord]:
+                for p in neighbours([coord], self.shape, -HALO_OFFSETS).tolist():
+                    p = tuple(p)
+                    exempt[p] = exempt.get(p, 0) + 1
+
+        return exempt
@@ -3,21 +3,36 @@ from __future__ import print_function
 from extractor import Extractor
 
 class MineTime:
+    # Redstone must be repeated every REPEATER_SPACING blocks of wire. Each
+    # repeater and each via delays the signal by this many ticks.
+    REPEATER_SPACING = 15
+    REPEATER_DELAY = 1
+    VIA_DELAY = 2
+
     def compute_net_delay(self, extracted_net):
         total = 0
         for extraction_type, _ in extracted_net:
             if extraction_type == Extractor.WIRE:
                 continue
             elif extraction_type == Extractor.REPEATER:
-                total += 1
+                total += self.REPEATER_DELAY
             elif extraction_type == Extractor.UP_VIA:
-                total += 2
+                total += self.VIA_DELAY
             elif extraction_type == Extractor.DOWN_VIA:
-                total += 2
+                total += self.VIA_DELAY
             else:
                 raise ValueError("Unknown extraction type", extraction_type)
         return total
 
+    def estimate_net_delay(self, distance, vias=0):
+        """
+        Estimate the delay of a net before it is routed, from the Manhattan
+        distance its wire covers and the number of vias it takes, using
+        the same rules as compute_net_delay().
+        """
+        repeaters = distance // self.REPEATER_SPACING
+        return repeaters * self.REPEATER_DELAY + vias * self.VIA_DELAY
+
     def compute_combinational_delay(self, placements, routing, cell_library):
         # For each input or sequential unit output,
         # find the longest delay to the output or to another sequential unit's input
@@ -34,12 +49,22 @@ class MineTime:
                     output_names.append(pin_name)
             return output_names
 
+        def endpoint(pin):
+            """
+            The cell index of a segment's pin, or ("steiner", k) for the
+            k-th Steiner point of the net.
+            """
+            if pin["cell_index"] is None:
+                return ("steiner", pin["steiner"])
+            return pin["cell_index"]
+
         def get_segments(net_name, cell_index):
             """
-            Get the segments of this net driven by this cell.
+            Get the segments of this net driven by this cell (or Steiner
+            point).
             """
             net_segments = routing[net_name]["segments"]
-            driven_segments = [segment for segment in net_segments if segment["pins"][0]["cell_index"] == cell_index]
+            driven_segments = [segment for segment in net_segments if endpoint(segment["pins"][0]) == cell_index]
             return driven_segments
 
         def dfs(driver_index, visited=[]):
@@ -82,9 +107,13 @@ class MineTime:
                             cumulative_delay = delay + cell_delay + segment_delay
 
                             # also see other nets driven by this one
-                            driven_cell_index = segment["pins"][1]["cell_index"]
+                            driven_cell_index = endpoint(segment["pins"][1])
                             indices_along_net.append(driven_cell_index)
 
+                            # Steiner points only branch the net
+                            if segment["pins"][1]["cell_index"] is None:
+                                continue
+
                             new_exploration = (explore_list[:] + [driven_cell_index], cumulative_delay, path[:] + [cell_name, driven_net])
                             to_explore.append(new_exploration)
 
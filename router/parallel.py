@@ -0,0 +1,123 @@
+from __future__ import print_function
+
+import numpy as np
+
+# How far each search window is grown before checking it against the
+# others in its batch. Windows grown by one block do not overlap if they
+# are at least two blocks apart, so that neither wire (nor the block
+# below it) is within the other's halo.
+REACH = 1
+
+# The router, set in each worker process by init_worker()
+worker_router = None
+
+def init_worker(router):
+    global worker_router
+    worker_router = router
+
+def route_in_window(args):
+    """
+    Route one segment within its search window (with A* if the router's
+    search is "astar", or Lee's algorithm otherwise), given the window's
+    slice of the halo counts and the exemptions around the pins (in window
+    coordinates). Returns the path in layout coordinates, or None if there
+    is no path within the window that violates nothing.
+    """
+    a, b, lo, halo_counts, exempt = args
+
+    def to_window(coord):
+        return tuple(p - q for p, q in zip(coord, lo))
+
+    shape = halo_counts.shape
+    worker_router.allocate_scratch(shape)
+    guided = worker_router.search == "astar"
+    net = worker_router.search_window(to_window(a), to_window(b), halo_counts, exempt,
+                                      ((0, 0, 0), shape), guided)
+    if net is None or worker_router.path_violates(net, halo_counts, exempt):
+        return None
+
+    return [tuple(p + q for p, q in zip(coord, lo)) for coord in net]
+
+def overlaps(box1, box2):
+    (lo1, hi1), (lo2, hi2) = box1, box2
+    return all(l1 < h2 and l2 < h1 for l1, h1, l2, h2 in zip(lo1, hi1, lo2, hi2))
+
+def partition(windows):
+    """
+    Greedily partition the windows, in order, into batches in which no
+    two windows (grown by REACH) overlap. Returns the batches as lists of
+    indices into windows.
+    """
+    batches = []
+    for k, (lo, hi) in enumerate(windows):
+        box = (tuple(p - REACH for p in lo), tuple(p + REACH for p in hi))
+        for indices, boxes in batches:
+            if not any(overlaps(box, other) for other in boxes):
+                indices.append(k)
+                boxes.append(box)
+                break
+        else:
+            batches.append(([k], [box]))
+
+    return [indices for indices, _ in batches]
+
+def parallel_route(router, routing, keys, placed_layout, usage, violations, map_segments):
+    """
+    Route the ripped-up segments keys, a list of (net name, segment index)
+    pairs in order of priority, in batches of segments whose search
+    windows (the pins' bounding box plus router.search_margin) do not
+    overlap.
+
+    The segments of a batch are routed with map_segments (e.g., a process
+    pool's map), each against the usage as it was before the batch. The
+    results are then committed in order; a route that conflicts with one
+    committed before it in the batch, or that found no path within its
+    window that violates nothing, is routed again with router.route_segment().
+    """
+    shape = usage.shape
+
+    pins = []
+    windows = []
+    for net_name, i in keys:
+        a, b = [tuple(pin["route_coord"]) for pin in routing[net_name]["segments"][i]["pins"]]
+        pins.append((a, b))
+        windows.append(router.pin_window(a, b, shape, router.search_margin))
+
+    batches = partition(windows)
+    print("Re-routing", len(keys), "nets in", len(batches), "batches")
+
+    for batch in batches:
+        jobs = []
+        for k in batch:
+            (a, b), (lo, hi) = pins[k], windows[k]
+            region = tuple(slice(l, h) for l, h in zip(lo, hi))
+
+            exempt = {}
+            for coord, count in usage.halo.exemptions(usage.matrix, [a, b]).iteritems():
+                if all(l <= p < h for p, l, h in zip(coord, lo, hi)):
+                    exempt[tuple(p - l for p, l in zip(coord, lo))] = count
+
+            jobs.append((a, b, lo, usage.halo.counts[region], exempt))
+
+        committed_wire = np.zeros(0, dtype=np.int)
+        committed_violation = np.zeros(0, dtype=np.int)
+        retry = []
+        for k, net in zip(batch, map_segments(route_in_window, jobs)):
+            if net is None:
+                retry.append(k)
+                continue
+
+            wire, violation = router.net_to_wire_and_violation(net, shape, list(pins[k]))
+            if len(np.intersect1d(wire, committed_violation)) > 0 or \
+               len(np.intersect1d(violation, committed_wire)) > 0:
+                retry.append(k)
+                continue
+
+            net_name, i = keys[k]
+            router.commit_segment(routing, net_name, i, net, usage, violations)
+            committed_wire = np.union1d(committed_wire, wire)
+            committed_violation = np.union1d(committed_violation, violation)
+
+        for k in retry:
+            net_name, i = keys[k]
+            router.route_segment(routing, net_name, i, placed_layout, usage, violations)
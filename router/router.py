@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import heapq
+import multiprocessing
 from copy import deepcopy
 from collections import defaultdict
 import random
@@ -8,14 +9,44 @@ import random
 import numpy as np
 from scipy.spatial.distance import cityblock
 
-from util.blocks import block_names
+from placer.store import as_store
+from halo import HaloMap, HALO_OFFSETS, dilate, neighbours
+from usage import UsageMap, ViolationIndex
+import parallel
+import steiner
 
 class Router:
     def __init__(self, blif, pregenerated_cells):
         self.blif = blif
         self.pregenerated_cells = pregenerated_cells
+        # Scratch matrices for maze_route(), allocated for the largest
+        # layout (or window) searched so far. An entry of cost_matrix or backtrace_matrix is only valid
+        # if the same entry of stamp_matrix holds the current generation,
+        # and a location is visited if visit_matrix holds it, so that
+        # nothing needs to be cleared between searches.
         self.cost_matrix = None
         self.backtrace_matrix = None
+        self.stamp_matrix = None
+        self.visit_matrix = None
+        self.generation = 0
+
+        # Path search: "lee" floods the whole layout, "astar" searches
+        # towards the target within a window around the pins
+        self.search = "lee"
+        self.search_margin = 8
+        # How many times an A* window may be doubled before the whole
+        # layout is searched instead
+        self.max_window_expansions = 2
+
+        # What a location that violates something costs, unless the
+        # search is negotiated
+        self.violation_cost = 1000
+
+        # Number of processes re_route() routes segments with
+        self.workers = 1
+
+        # Whether nets are decomposed into rectilinear Steiner trees
+        self.steiner = False
 
     def extract_extended_pin_locations(self, placements):
         """
@@ -36,160 +67,92 @@ class Router:
         where a router should start from.
         """
 
-        def extend_pin(coord, facing):
-            """
-            Returns the coordinates of the pin based moving in the
-            direction given by "facing".
-            """
-            (y, z, x) = coord
+        store = as_store(placements, self.pregenerated_cells)
 
-            if facing == "north":
-                z -= 1
-            elif facing == "west":
-                x -= 1
-            elif facing == "south":
-                z += 1
-            elif facing == "east":
-                x += 1
-
-            return (y, z, x)
+        pin_coords = store.pin_coordinates()
+        extended_coords = pin_coords + store.pin_facings()
+        is_outputs = store.pin_outputs()
 
         net_pins = defaultdict(list)
 
         # For each wire, locate its pins according to the placement
-        for i, placement in enumerate(placements):
-            # Do the cell lookup
-            rotation = placement["turns"]
-            cell_name = placement["name"]
-            cell = self.pregenerated_cells[cell_name][rotation]
-
-            yy, zz, xx = placement["placement"]
-
-            for pin, d in cell.ports.iteritems():
-                (y, z, x) = d["coordinates"]
-                facing = d["facing"]
-                is_output = (d["direction"] == "output")
-                coord = (y + yy, z + zz, x + xx)
-                extended_coord = extend_pin(coord, facing)
-                net_name = placement["pins"][pin]
-
-                net_pin_info = {"cell_index": i,
-                                "pin": pin,
-                                "pin_coord": coord,
-                                "route_coord": extended_coord,
-                                "is_output": is_output}
-                net_pins[net_name].append(net_pin_info)
+        pins = zip(store.pin_cell.tolist(), store.pin_net.tolist(),
+                   pin_coords.tolist(), extended_coords.tolist(),
+                   is_outputs.tolist())
+        for k, (i, net, coord, extended_coord, is_output) in enumerate(pins):
+            net_name = store.net_names[net]
+
+            net_pin_info = {"cell_index": i,
+                            "pin": store.pin_name(k),
+                            "pin_coord": tuple(coord),
+                            "route_coord": tuple(extended_coord),
+                            "is_output": is_output}
+            net_pins[net_name].append(net_pin_info)
 
         return net_pins
 
-    def create_net_segments(self, pin_locations):
-
-        def minimum_spanning_tree(size, distance_metric):
-            """
-            Compute the segments that form the minimum spanning tree,
-            using Kruskal's algorithm.
-
-            The input is the size of the graph, and the tree is organized
-            as a list of elements, with no gaps. (To be precise,
-            distance_metric(u, v) must be defined for all u, v in [0, size).)
-
-            distance_metric(u, v) is the function that computes the distance
-            between the nodes indexed u and v.
-
-            The output is a list of (i, j) pairs specifying the MST.
-            """
-
-            # Create sets for each of the pins
-            sets = []
-            for i in xrange(size):
-                s = set([i])
-                sets.append(s)
-
-            # Compute the weight matrix
-            weights = {}
-            for i in xrange(size):
-                for j in xrange(i+1, size):
-                    weights[(i, j)] = distance_metric(i, j)
-
-            def find_set(u):
-                for i, s in enumerate(sets):
-                    if u in s:
-                        return i
-                return -1
-
-            # Create spanning tree!
-            A = set()
-            for u, v in sorted(weights, key=weights.get):
-                u_i = find_set(u)
-                v_i = find_set(v)
-                if u_i != v_i:
-                    A.add((u, v))
-                    # Union the two sets
-                    sets[v_i] |= sets[u_i]
-                    sets.pop(u_i)
-
-            return A
-
-        def dag_from_output_mst(graph_connections, pin_list):
-            """
-            Perform a depth-first search from the locations marked output
-            so that all tuples are ordered so that the driver comes first
-            and the driven pin comes second.
-            """
-            # Each MST has n nodes and n-1 edges.
-            drivers = set()
-
-            for u, v in graph_connections:
-                uio = pin_list[u]["is_output"]
-                vio = pin_list[v]["is_output"]
-
-                if uio:
-                    drivers.add(u)
-                if vio:
-                    drivers.add(v)
-
-            dag = []
-            # Assemble the DAG
-            seen = [False] * len(graph_connections)
-            while not all(seen):
-                for i, (u, v) in enumerate(graph_connections):
-                    if seen[i]:
-                        continue
-
-                    # If one of the endpoints of the segment appears in
-                    # drivers, then now the other end is driven, and is
-                    # therefore a driver.
-                    if u in drivers:
-                        dag.append((u, v))
-                        drivers.add(v)
-                        seen[i] = True
-                    elif v in drivers:
-                        dag.append((v, u))
-                        drivers.add(u)
-                        seen[i] = True
-
-            assert len(dag) == len(graph_connections)
-
-            dag = [(pin_list[u], pin_list[v]) for (u, v) in dag]
-            return dag
-
+    def create_net_segments(self, pin_locations, blocked=None):
+        """
+        Decompose each net into segments between two pins, returning a
+        dictionary keyed on net names, with lists of (driver pin info,
+        driven pin info) pairs.
+
+        The segments of a net form the minimum spanning tree of its pins'
+        route coordinates (using Kruskal's algorithm), oriented away from
+        the pin that drives it.
+
+        If self.steiner is set, Steiner points are added to nets of three
+        or more pins (and no more than 500) first, which shortens the tree
+        of high-fanout nets.
+        They appear in segments as pin infos with a "steiner" index and no
+        cell. blocked is a Boolean matrix of locations that can't be
+        Steiner points.
+        """
         net_segments = {}
         for net, pin_list in pin_locations.iteritems():
             if len(pin_list) < 2:
                 continue
 
-            # Define the metric on the pin list
-            def metric(u, v):
-                coord_u = pin_list[u]["route_coord"]
-                coord_v = pin_list[v]["route_coord"]
-                return cityblock(coord_u, coord_v)
+            nodes = list(pin_list)
+            coords = np.array([pin["route_coord"] for pin in pin_list])
 
-            graph_connections = minimum_spanning_tree(len(pin_list), metric)
-            dag = dag_from_output_mst(graph_connections, pin_list)
-            net_segments[net] = dag
+            if self.steiner and len(pin_list) > 2:
+                points = steiner.steiner_points(coords, blocked)
+                for k, point in enumerate(points.tolist()):
+                    nodes.append({"cell_index": None,
+                                  "pin": None,
+                                  "steiner": k,
+                                  "pin_coord": tuple(point),
+                                  "route_coord": tuple(point),
+                                  "is_output": False})
+                coords = np.concatenate((coords, points))
+
+            tree, _ = steiner.minimum_spanning_tree(coords)
+
+            drivers = [k for k, pin in enumerate(nodes) if pin["is_output"]]
+            root = drivers[0] if drivers else 0
+            dag = steiner.orient_tree(len(nodes), tree, root)
+
+            net_segments[net] = [(nodes[u], nodes[v]) for u, v in dag]
 
         return net_segments
 
+    def blocked_locations(self, placements, dimensions):
+        """
+        Returns a Boolean matrix of the locations a wire can't pass through
+        without a violation: the blocks of the placed cells, and the
+        locations that transmit to them.
+        """
+        store = as_store(placements, self.pregenerated_cells)
+
+        used = np.zeros(dimensions, dtype=np.bool)
+        cells = zip(store.type_ids.tolist(), store.turns.tolist(), store.coords.tolist())
+        for type_id, rotation, (y, z, x) in cells:
+            h, w, l = store.shapes[type_id, rotation]
+            used[y:y+h, z:z+w, x:x+l] |= store.footprints[type_id][rotation]
+
+        return used | (dilate(used) > 0)
+
     def dumb_route(self, a, b):
         """
         Routes, on one Y layer only, the path between a and b, going
@@ -221,49 +184,39 @@ class Router:
     def net_to_wire_and_violation(self, net, dimensions, pins):
         """
         Converts a realized net, which is a list of block positions from
-        one pin to another, into two matrices:
+        one pin to another, into two sorted arrays of flat indices into a
+        layout of the given dimensions:
         - wire: the redstone + stone block
         - violation: the places where this redstone may possibly transmit
 
         The net is the list of where the _redstone_ is.
         """
-        wire = np.zeros(dimensions, dtype=np.uint8)
-        violation = np.zeros(dimensions, dtype=np.bool)
+        coords = np.array(net, dtype=np.int).reshape(-1, 3)
 
-        redstone = block_names.index("redstone_wire")
-        stone = block_names.index("stone")
+        # Generate the wire itself: the redstone, and the block below it
+        below = coords - (1, 0, 0)
+        below = below[below[:, 0] >= 0]
+        wire_coords = np.concatenate((coords, below))
+        wire = np.unique(np.ravel_multi_index(tuple(wire_coords.T), dimensions))
 
-        violation_directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+        # Generate the violations, except around the pins
+        pins = set(tuple(pin) for pin in pins)
+        not_pin = np.array([tuple(coord) not in pins for coord in net], dtype=np.bool)
+        halo = neighbours(coords[not_pin], dimensions)
+        violation = np.ravel_multi_index(tuple(halo.T), dimensions)
 
-        for coord in net:
-            y, z, x = coord
-            # Generate the wire itself
-            wire[y, z, x] = redstone
-            wire[y - 1, z, x] = stone
-
-            # Generate the violation matrix, unless it's a pin
-            if coord not in pins:
-                for vy in [0, -1]:
-                    for vz, vx in violation_directions:
-                        try:
-                            violation[y + vy, z + vz, x + vx] = True
-                        except IndexError:
-                            pass
-
-        # Remove "wire" from the violation matrix so that it doesn't
-        # violate itself
-        for y, z, x in net:
-            violation[y, z, x] = False
-            violation[y - 1, z, x] = False
+        # Remove "wire" from the violations so that it doesn't violate
+        # itself
+        violation = np.setdiff1d(violation, wire)
 
         return wire, violation
 
     def compute_net_violations(self, violation, occupieds):
         """
-        For each non-zero entry, see if there is anything in "occupieds".
+        For each flat index in violation, see if there is anything in
+        "occupieds".
         """
-        violations = np.logical_and(violation, occupieds)
-        return sum(violations.flat)
+        return np.count_nonzero(occupieds.take(violation))
 
     def initial_routing(self, placements, layout_dimensions):
         """
@@ -275,8 +228,8 @@ class Router:
               segments: [
                 { pins: [(ay, az, ax), (by, bz, bx)],
                   net: [path of redstone],
-                  wire: [path of redstone and blocks],
-                  violation: [violation matrix]
+                  wire: [flat indices of redstone and blocks],
+                  violation: [flat indices of violations]
                 }
               ]
             }
@@ -285,7 +238,11 @@ class Router:
         routings = {}
 
         pin_locations = self.extract_extended_pin_locations(placements)
-        net_segments = self.create_net_segments(pin_locations)
+
+        blocked = None
+        if self.steiner:
+            blocked = self.blocked_locations(placements, layout_dimensions)
+        net_segments = self.create_net_segments(pin_locations, blocked)
 
         for net_name, segment_endpoints in net_segments.iteritems():
             segments = []
@@ -302,19 +259,20 @@ class Router:
 
         return routings
 
-    def generate_usage_matrix(self, placed_layout, routing, exclude=[]):
+    def generate_usage_map(self, placed_layout, routing):
+        """
+        Returns a UsageMap of the placed cells and every segment of the
+        routing, which segments can then be added to and removed from.
+        """
         blocks, _ = placed_layout
-        usage_matrix = np.copy(blocks)
+        usage = UsageMap(blocks)
         for net_name, d in routing.iteritems():
-            for i, segment in enumerate(d["segments"]):
-                if (net_name, i) in exclude:
-                    continue
-                else:
-                    usage_matrix = np.logical_or(usage_matrix, segment["wire"])
+            for segment in d["segments"]:
+                usage.add(segment["wire"])
 
-        return usage_matrix
+        return usage
 
-    def score_routing(self, routing, usage_matrix):
+    def score_routing(self, routing, usage_matrix, violations=None):
         """
         For the given layout, and the routing, produce the score of the
         routing.
@@ -325,6 +283,10 @@ class Router:
         and the lower bound on its length.
 
         layout is the 3D matrix produced by the placer.
+
+        If violations is given, it is a dictionary of the number of
+        violations of each (net name, segment index), which is used
+        instead of counting them against usage_matrix.
         """
         alpha = 3
         beta = 0.1
@@ -342,9 +304,11 @@ class Router:
                 routed_net = segment["net"]
 
                 # Violations
-                violation_matrix = segment["violation"]
-                violations = self.compute_net_violations(violation_matrix, usage_matrix)
-                net_num_violations[net_name].append(violations)
+                if violations is None:
+                    num_violations = self.compute_net_violations(segment["violation"], usage_matrix)
+                else:
+                    num_violations = violations[(net_name, i)]
+                net_num_violations[net_name].append(num_violations)
 
                 # Number of vias and pins
                 vias = 0
@@ -357,7 +321,7 @@ class Router:
                 lower_length_bound = max(1, cityblock(coord_a, coord_b))
                 length_ratio = len(routed_net) / lower_length_bound
 
-                score = (alpha * violations) + (beta * pins_vias) + (gamma * length_ratio)
+                score = (alpha * num_violations) + (beta * pins_vias) + (gamma * length_ratio)
 
                 net_scores[net_name].append(score)
 
@@ -396,46 +360,141 @@ class Router:
 
         return rip_up
 
-    def maze_route(self, a, b, placed_layout, usage_matrix):
+    def maze_route(self, a, b, placed_layout, usage_matrix, halo=None, history=None, present_factor=1):
         """
         Given two pins to re-route, find the best path using Lee's maze
         routing algorithm.
+
+        halo is the HaloMap of usage_matrix; if it is not given, it is
+        computed here.
+
+        By default, every location that violates something costs a fixed
+        penalty. If history (a matrix of historical congestion costs) is
+        given, a location instead costs its movement cost plus its history
+        cost, multiplied by 1 + present_factor times the number of used
+        locations it violates, as in PathFinder.
+
+        If self.search is "astar", the search is instead guided towards b
+        by its Manhattan distance (a lower bound on the remaining cost,
+        since a via costs as much as the height it climbs), and is
+        confined to the bounding box of a and b plus self.search_margin
+        blocks on every side. If no path is found in the window, or (unless
+        history is given) only one that violates something, the margin is
+        doubled and the search repeated, up to self.max_window_expansions
+        times; after that, the whole layout is searched.
         """
         blocks, _ = placed_layout
+        shape = blocks.shape
+        self.allocate_scratch(shape)
+
+        if halo is None:
+            halo = HaloMap(usage_matrix)
+
+        # The pins don't count as violations, so discount what the
+        # locations around them see of them
+        exempt = halo.exemptions(usage_matrix, [a, b])
 
-        def clear_matrices():
-            height, width, length = self.cost_matrix.shape
-            for y in xrange(height):
-                for z in xrange(width):
-                    for x in xrange(length):
-                        self.cost_matrix[y, z, x] = -1
-                        self.backtrace_matrix[y, z, x] = 0
-
-        # If not created yet, create the cost matrices, otherwise, just zero them out
-        if self.cost_matrix is None or self.backtrace_matrix is None:
-            self.cost_matrix = np.full_like(blocks, -1, dtype=np.int)
-            self.backtrace_matrix = np.zeros_like(blocks, dtype=np.int)
+        if self.search != "astar":
+            window = ((0, 0, 0), shape)
+            net = self.search_window(a, b, halo.counts, exempt, window, False, history, present_factor)
         else:
-            clear_matrices()
-
-        def violating(coord):
-            if coord in [a, b]:
-                return False
-
-            violation_directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]
-            for dy in [0, -1]:
-                for dz, dx in violation_directions:
-                    y, z, x = coord
-                    new_coord = (y + dy, z + dz, x + dx)
-                    if new_coord in [a, b]:
-                        continue
-                    try:
-                        if usage_matrix[new_coord]:
-                            return True
-                    except IndexError:
-                        continue
-
-            return False
+            margin = self.search_margin
+            expansions = 0
+            while True:
+                if expansions < self.max_window_expansions:
+                    lo, hi = self.pin_window(a, b, shape, margin)
+                else:
+                    lo, hi = (0, 0, 0), shape
+                net = self.search_window(a, b, halo.counts, exempt, (lo, hi), True, history, present_factor)
+
+                if lo == (0, 0, 0) and hi == shape:
+                    break
+                if net is not None and (history is not None or not self.path_violates(net, halo.counts, exempt)):
+                    break
+                margin *= 2
+                expansions += 1
+
+        if net is None:
+            raise ValueError("No path between {} and {} found!".format(a, b))
+
+        print("Net score:", self.cost_matrix[b], " Length:", len(net))
+        return net
+
+    def path_violates(self, net, halo_counts, exempt):
+        """
+        Returns whether any location of net, other than its ends, violates
+        a used location (see search_window()).
+        """
+        for coord in net[1:-1]:
+            if halo_counts[coord] - exempt.get(coord, 0) > 0:
+                return True
+        return False
+
+    def allocate_scratch(self, shape):
+        """
+        Create the scratch matrices for searches in a layout of the given
+        shape, unless they already exist and are at least as large. (A
+        search only reads the entries within its window.)
+        """
+        if self.cost_matrix is not None:
+            if all(n <= m for n, m in zip(shape, self.cost_matrix.shape)):
+                return
+            shape = tuple(max(n, m) for n, m in zip(shape, self.cost_matrix.shape))
+
+        self.cost_matrix = np.zeros(shape, dtype=np.float)
+        self.backtrace_matrix = np.zeros(shape, dtype=np.int8)
+        self.stamp_matrix = np.zeros(shape, dtype=np.int)
+        self.visit_matrix = np.zeros(shape, dtype=np.int)
+        self.generation = 0
+
+    def pin_window(self, a, b, shape, margin):
+        """
+        Returns the (lower corner, upper corner) of the bounding box of a
+        and b plus margin on every side, within shape. The upper corner is
+        exclusive.
+        """
+        lo = tuple(max(0, min(p, q) - margin) for p, q in zip(a, b))
+        hi = tuple(min(n, max(p, q) + margin + 1) for p, q, n in zip(a, b, shape))
+        return lo, hi
+
+    def search_window(self, a, b, halo_counts, exempt, window, guided, history=None, present_factor=1):
+        """
+        Find the cheapest path from a to b that stays within window, a
+        (lower corner, upper corner) pair of (y, z, x) coordinates. The
+        upper corner is exclusive.
+
+        The number of used locations that a location violates is its count
+        in halo_counts (the counts of a HaloMap) less its count in exempt.
+        Its cost is as described in maze_route().
+
+        If guided, nodes are expanded in order of their cost plus their
+        Manhattan distance to b (A*); otherwise, in order of their cost
+        alone (Dijkstra). The search stops as soon as b is reached.
+
+        Returns the path from a to b, or None if there isn't one.
+        """
+        (y0, z0, x0), (y1, z1, x1) = window
+
+        # Start a new generation, invalidating the previous search
+        self.generation += 1
+        generation = self.generation
+        cost_matrix = self.cost_matrix
+        backtrace_matrix = self.backtrace_matrix
+        stamp_matrix = self.stamp_matrix
+        visit_matrix = self.visit_matrix
+
+        def num_violating(coord):
+            if coord == a or coord == b:
+                return 0
+            return halo_counts[coord] - exempt.get(coord, 0)
+
+        by, bz, bx = b
+
+        def heuristic(coord):
+            if not guided:
+                return 0
+            y, z, x = coord
+            return abs(y - by) + abs(z - bz) + abs(x - bx)
 
         # Possible list of movements
         EAST = 1
@@ -456,96 +515,137 @@ class Router:
         backtraces = [WEST, SOUTH, EAST, NORTH, DOWN, UP]
         costs = [1, 1, 1, 1, 3, 3]
 
-        violation_cost = 1000
+        violation_cost = self.violation_cost
 
-        # Start breadth-first with a
-        visited = np.zeros_like(blocks, dtype=bool)
-        heap_locations = np.zeros_like(blocks, dtype=bool)
+        # Start with a; heap entries are (estimated total cost, cost, location)
         min_dist_heap = []
-        self.cost_matrix[a] = 0
-        heapq.heappush(min_dist_heap, (0, a))
-        heap_locations[a] = 1
-
-        visited_size = sum(visited.flat != 0)
+        cost_matrix[a] = 0
+        stamp_matrix[a] = generation
+        heapq.heappush(min_dist_heap, (heuristic(a), 0, a))
 
         while len(min_dist_heap) > 0:
-            # print("{} -> {}".format(len(to_visit), len(visited)))
-            _, location = heapq.heappop(min_dist_heap)
-            heap_locations[location] = 0
-            visited[location] = 1
+            _, cost, location = heapq.heappop(min_dist_heap)
+            if visit_matrix[location] == generation:
+                continue
+            visit_matrix[location] = generation
+
+            if location == b:
+                break
 
             # For each candidate movement
             for movement, backtrace, movement_cost in zip(movements, backtraces, costs):
                 dy, dz, dx = movement
                 y, z, x = location
-                new_location = (y + dy, z + dz, x + dx)
+                ny, nz, nx = new_location = (y + dy, z + dz, x + dx)
 
-                try:
-                    # less-than-zero checks
-                    if y + dy < 0 or z + dz < 0 or x + dx < 0:
-                        continue
+                if not (y0 <= ny < y1 and z0 <= nz < z1 and x0 <= nx < x1):
+                    continue
 
-                    if visited[new_location] == 1:
-                        continue
+                if visit_matrix[new_location] == generation:
+                    continue
 
-                    if violating(new_location):
-                        new_location_cost = self.cost_matrix[location] + violation_cost
-                    else:
-                        new_location_cost = self.cost_matrix[location] + movement_cost
+                violating = num_violating(new_location)
+                if history is not None:
+                    base_cost = movement_cost + history[new_location]
+                    new_location_cost = cost + base_cost * (1 + present_factor * violating)
+                elif violating > 0:
+                    new_location_cost = cost + violation_cost
+                else:
+                    new_location_cost = cost + movement_cost
 
-                    # print(location, cost_matrix[location], "->", new_location, cost_matrix[new_location], new_location_cost)
-                    if self.cost_matrix[new_location] == -1 or new_location_cost < self.cost_matrix[new_location]:
-                        self.cost_matrix[new_location] = new_location_cost
-                        self.backtrace_matrix[new_location] = backtrace
+                if stamp_matrix[new_location] != generation or new_location_cost < cost_matrix[new_location]:
+                    cost_matrix[new_location] = new_location_cost
+                    backtrace_matrix[new_location] = backtrace
+                    stamp_matrix[new_location] = generation
+                    estimate = new_location_cost + heuristic(new_location)
+                    heapq.heappush(min_dist_heap, (estimate, new_location_cost, new_location))
 
-                    if heap_locations[new_location] == 0:
-                        heapq.heappush(min_dist_heap, (new_location_cost, new_location))
-                        heap_locations[new_location] = 1
+        if visit_matrix[b] != generation:
+            return None
 
-                except IndexError:
-                    continue
+        # Backtrace
+        backtrace_movements = [MOVE_WEST, MOVE_SOUTH, MOVE_EAST, MOVE_NORTH, MOVE_DOWN, MOVE_UP]
+        net = [b]
+        while net[-1] != a:
+            last = net[-1]
+            backtrace_entry = backtrace_matrix[last]
+            if backtrace_entry == 0 or backtrace_entry > 6:
+                raise ValueError("Unknown backtrace entry {}".format(backtrace_entry))
+            movement = backtrace_movements[backtraces.index(backtrace_entry)]
+            dy, dz, dx = movement
+            y, z, x = net[-1]
+            back_location = (y + dy, z + dz, x + dx)
+            net.append(back_location)
+
+        net.reverse()
+        return net
 
+    def rip_up_segment(self, routing, net_name, i, usage, violations):
+        """
+        Remove segment i of the net from usage (a UsageMap) and violations
+        (a ViolationIndex).
+        """
+        segment = routing[net_name]["segments"][i]
+        violations.remove_segment((net_name, i), segment["violation"])
+        violations.update(usage.remove(segment["wire"]), -1)
 
-        # Backtrace, if a path found
-        backtrace_movements = [MOVE_WEST, MOVE_SOUTH, MOVE_EAST, MOVE_NORTH, MOVE_DOWN, MOVE_UP]
-        if visited[b] == 1:
-            net = [b]
-            while net[-1] != a:
-                last = net[-1]
-                backtrace_entry = self.backtrace_matrix[last]
-                if backtrace_entry == 0 or backtrace_entry > 6:
-                    raise ValueError("Unknown backtrace entry {}".format(backtrace_entry))
-                movement = backtrace_movements[backtraces.index(backtrace_entry)]
-                dy, dz, dx = movement
-                y, z, x = net[-1]
-                back_location = (y + dy, z + dz, x + dx)
-                net.append(back_location)
+    def route_segment(self, routing, net_name, i, placed_layout, usage, violations, history=None, present_factor=1):
+        """
+        Route segment i of the net, which has been ripped up, with
+        maze_route(), and add the new route to usage and violations.
+        """
+        pin_info_a, pin_info_b = routing[net_name]["segments"][i]["pins"]
+        a = pin_info_a["route_coord"]
+        b = pin_info_b["route_coord"]
 
-            print("Net score:", self.cost_matrix[b], " Length:", len(net))
-            net.reverse()
-            return net
-        else:
-            raise ValueError("No path between {} and {} found!".format(a, b))
-            # print(cost_matrix[1])
-            # print(backtrace_matrix[1])
-            return None
+        new_net = self.maze_route(a, b, placed_layout, usage.matrix, usage.halo, history, present_factor)
+        self.commit_segment(routing, net_name, i, new_net, usage, violations)
+
+    def commit_segment(self, routing, net_name, i, new_net, usage, violations):
+        """
+        Set the route of segment i of the net, which has been ripped up, to
+        new_net, and add it to usage and violations.
+        """
+        segment = routing[net_name]["segments"][i]
+        a, b = [pin["route_coord"] for pin in segment["pins"]]
+        w, v = self.net_to_wire_and_violation(new_net, usage.shape, [a, b])
+        segment["net"] = new_net
+        segment["wire"] = w
+        segment["violation"] = v
+
+        # Re-add this net to the usage and the violations
+        violations.update(usage.add(w), 1)
+        violations.add_segment((net_name, i), v)
 
     def re_route(self, initial_routing, placed_layout):
         """
         re_route() produces new routings until there are no more net
         violations that cause the routing to be infeasible.
+
+        If self.workers is greater than 1, the ripped-up segments are
+        routed across a process pool, in batches whose search windows do
+        not overlap (see parallel.parallel_route()).
         """
-        usage_matrix = self.generate_usage_matrix(placed_layout, initial_routing)
+        usage = self.generate_usage_map(placed_layout, initial_routing)
+
+        # Index the violations of every segment, to update them as
+        # segments are ripped up and re-routed
+        violations = ViolationIndex(usage)
+        for net_name, d in initial_routing.iteritems():
+            for i, segment in enumerate(d["segments"]):
+                violations.add_segment((net_name, i), segment["violation"])
 
         # Score the initial routing
-        net_scores, net_violations = self.score_routing(initial_routing, usage_matrix)
+        net_scores, net_violations = self.score_routing(initial_routing, usage.matrix, violations.counts)
         num_violations = sum(sum(net_violations.itervalues(), []))
         iterations = 0
 
         routing = deepcopy(initial_routing)
 
-        blocks, _ = placed_layout
-        shape = blocks.shape
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, parallel.init_worker, (self,))
+        else:
+            pool = None
 
         try:
             while num_violations > 0:
@@ -557,46 +657,121 @@ class Router:
                 # Select nets to rip-up and re-route
                 rip_up = self.natural_selection(normalized_scores)
 
-                # Re-route these nets
-                usage_matrix = self.generate_usage_matrix(placed_layout, routing, exclude=rip_up)
-
-                print("Re-routing", len(rip_up), "nets")
-                for net_name, i in sorted(rip_up, key=lambda x: normalized_scores[x[0]][x[1]], reverse=True):
-                    pin_info_a, pin_info_b = routing[net_name]["segments"][i]["pins"]
-                    a = pin_info_a["route_coord"]
-                    b = pin_info_b["route_coord"]
-                    new_net = self.maze_route(a, b, placed_layout, usage_matrix)
-                    routing[net_name]["segments"][i]["net"] = new_net
+                # Rip up these nets
+                for net_name, i in rip_up:
+                    self.rip_up_segment(routing, net_name, i, usage, violations)
 
-                    w, v = self.net_to_wire_and_violation(new_net, shape, [a, b])
-                    routing[net_name]["segments"][i]["wire"] = w
-                    routing[net_name]["segments"][i]["violation"] = v
-
-                    # Re-add this net to the usage matrix
-                    usage_matrix = np.logical_or(usage_matrix, w)
+                rip_up = sorted(rip_up, key=lambda x: normalized_scores[x[0]][x[1]], reverse=True)
+                if pool is not None:
+                    parallel.parallel_route(self, routing, rip_up, placed_layout, usage, violations, pool.map)
+                else:
+                    print("Re-routing", len(rip_up), "nets")
+                    for net_name, i in rip_up:
+                        self.route_segment(routing, net_name, i, placed_layout, usage, violations)
 
                 # Re-score this net
-                net_scores, net_violations = self.score_routing(routing, usage_matrix)
+                net_scores, net_violations = self.score_routing(routing, usage.matrix, violations.counts)
                 num_violations = sum(sum(net_violations.itervalues(), []))
                 iterations += 1
                 print()
         except KeyboardInterrupt:
-            pass
+            if pool is not None:
+                pool.terminate()
+                pool = None
+
+        if pool is not None:
+            pool.close()
+            pool.join()
 
         return routing
 
+    def negotiated_route(self, initial_routing, placed_layout, max_iterations=50, patience=5,
+                         present_factor=0.5, present_growth=1.5, history_factor=1.0):
+        """
+        negotiated_route() is an alternative to re_route() based on
+        PathFinder's negotiated congestion. Every iteration, every segment
+        is ripped up and re-routed in turn, where the cost of a location
+        grows with the number of used locations it violates (by
+        present_factor, which grows by present_growth each iteration) and
+        with its history cost. After each iteration, the history cost of
+        the locations around every violated location grows by
+        history_factor, so that segments that keep contending for the same
+        space are pushed apart.
+
+        Routing stops when there are no violations, when the number of
+        violations has not improved for patience iterations, or after
+        max_iterations. The routing with the fewest violations is
+        returned.
+        """
+        routing = deepcopy(initial_routing)
+        blocks, _ = placed_layout
+        shape = blocks.shape
+
+        usage = self.generate_usage_map(placed_layout, routing)
+        violations = ViolationIndex(usage)
+        for net_name, d in routing.iteritems():
+            for i, segment in enumerate(d["segments"]):
+                violations.add_segment((net_name, i), segment["violation"])
+
+        keys = sorted(violations.counts)
+        history = np.zeros(shape, dtype=np.float)
+
+        num_violations = sum(violations.counts.itervalues())
+        best_routing, best_violations = deepcopy(routing), num_violations
+        stalled = 0
+
+        try:
+            for iteration in xrange(max_iterations):
+                print("Iteration:", iteration, " Violations:", num_violations, " Present factor:", present_factor)
+                if num_violations == 0 or stalled >= patience:
+                    break
+
+                for net_name, i in keys:
+                    self.rip_up_segment(routing, net_name, i, usage, violations)
+                    self.route_segment(routing, net_name, i, placed_layout, usage, violations, history, present_factor)
+
+                # Raise the history cost around every violated location
+                for (net_name, i), count in violations.counts.iteritems():
+                    if count > 0:
+                        violation = routing[net_name]["segments"][i]["violation"]
+                        contested = usage.coordinates(violation[usage.matrix.take(violation)])
+                        seen_from = neighbours(contested, shape, -HALO_OFFSETS)
+                        np.add.at(history, tuple(seen_from.T), history_factor)
+
+                present_factor *= present_growth
+
+                num_violations = sum(violations.counts.itervalues())
+                if num_violations < best_violations:
+                    best_routing, best_violations = deepcopy(routing), num_violations
+                    stalled = 0
+                else:
+                    stalled += 1
+                print()
+        except KeyboardInterrupt:
+            pass
+
+        if best_violations == 0:
+            print("Routing converged")
+        else:
+            print("Routing stopped with", best_violations, "violations")
+
+        return best_routing
+
     def serialize_routing(self, original_routing, shape, f):
         """
-        Return the routing without the wire or the violation matrices
-        (which can't be serialized as-is and takes too much space
-        anyway).
+        Write the routing, with the wire and violation indices of each
+        segment as lists, followed by the shape of the layout.
         """
         import json
-        routing = deepcopy(original_routing)
-        for net_name, net in routing.iteritems():
-            for i, segment in enumerate(net["segments"]):
-                del segment["violation"]
-                del segment["wire"]
+        routing = {}
+        for net_name, net in original_routing.iteritems():
+            segments = []
+            for segment in net["segments"]:
+                segment = dict(segment)
+                segment["wire"] = segment["wire"].tolist()
+                segment["violation"] = segment["violation"].tolist()
+                segments.append(segment)
+            routing[net_name] = dict(net, segments=segments)
 
         json.dump(routing, f)
         f.write("\n")
@@ -608,11 +783,15 @@ class Router:
         shape = json.loads(f.readline())
         for net_name, net in routing.iteritems():
             for i, segment in enumerate(net["segments"]):
-                a, b = segment["pins"]
-                n = segment["net"]
-                w, v = self.net_to_wire_and_violation(n, shape, [a, b])
-                segment["wire" ] = w
-                segment["violation"] = v
+                # Routings written before the indices were saved only
+                # have the nets
+                if "wire" not in segment:
+                    a, b = [pin["route_coord"] for pin in segment["pins"]]
+                    n = segment["net"]
+                    segment["wire"], segment["violation"] = self.net_to_wire_and_violation(n, shape, [a, b])
+
+                segment["wire"] = np.array(segment["wire"], dtype=np.int)
+                segment["violation"] = np.array(segment["violation"], dtype=np.int)
 
         return routing
 
@@ -0,0 +1,276 @@
+from __future__ import print_function
+
+from collections import deque
+
+import numpy as np
+
+class DisjointSets(object):
+    """
+    DisjointSets is a union-find structure over the integers [0, size),
+    with path compression and union by rank.
+    """
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.rank = [0] * size
+
+    def find(self, u):
+        parent = self.parent
+        root = u
+        while parent[root] != root:
+            root = parent[root]
+        while parent[u] != root:
+            parent[u], u = root, parent[u]
+        return root
+
+    def union(self, u, v):
+        """
+        Merge the sets containing u and v. Returns False if they were
+        already the same set.
+        """
+        u, v = self.find(u), self.find(v)
+        if u == v:
+            return False
+
+        if self.rank[u] < self.rank[v]:
+            u, v = v, u
+        self.parent[v] = u
+        if self.rank[u] == self.rank[v]:
+            self.rank[u] += 1
+        return True
+
+def pairwise_distances(coords):
+    """
+    Returns the matrix of Manhattan distances between each pair of the
+    (n, 3) coordinates.
+    """
+    coords = np.asarray(coords, dtype=np.int).reshape(-1, 3)
+    return np.abs(coords[:, np.newaxis, :] - coords[np.newaxis, :, :]).sum(axis=2)
+
+def kruskal(size, us, vs, weights):
+    """
+    Compute the minimum spanning tree of the graph of size nodes with an
+    edge (us[k], vs[k]) of weights[k] for each k, using Kruskal's
+    algorithm.
+
+    Returns the tree as a list of (u, v) pairs, and its total weight.
+    """
+    sets = DisjointSets(size)
+    tree = []
+    total = 0
+    for k in np.argsort(weights, kind="mergesort").tolist():
+        if sets.union(us[k], vs[k]):
+            tree.append((us[k], vs[k]))
+            total += weights[k]
+            if len(tree) == size - 1:
+                break
+
+    return tree, total
+
+def minimum_spanning_tree(coords):
+    """
+    Returns the minimum spanning tree of the (n, 3) coordinates under the
+    Manhattan distance, as a list of (u, v) index pairs, and its length.
+    """
+    n = len(coords)
+    us, vs = np.triu_indices(n, 1)
+    weights = pairwise_distances(coords)[us, vs]
+    return kruskal(n, us.tolist(), vs.tolist(), weights.tolist())
+
+def orient_tree(size, tree, root):
+    """
+    Orient the edges of the tree away from the root (e.g., the driver of a
+    net) with a breadth-first search, so that the first node of each
+    (u, v) pair is the one nearer the root.
+    """
+    adjacent = [[] for _ in xrange(size)]
+    for u, v in tree:
+        adjacent[u].append(v)
+        adjacent[v].append(u)
+
+    seen = [False] * size
+    seen[root] = True
+
+    dag = []
+    queue = deque([root])
+    while queue:
+        u = queue.popleft()
+        for v in adjacent[u]:
+            if not seen[v]:
+                seen[v] = True
+                dag.append((u, v))
+                queue.append(v)
+
+    assert len(dag) == len(tree)
+    return dag
+
+def nearest_neighbours(points, coords, k):
+    """
+    Returns, for each of the (m, 3) coords, the indices of its k nearest
+    points (by Manhattan distance) as an (m, k) array, and the distances
+    to them. Coordinates are handled in chunks to bound the memory used.
+    """
+    k = min(k, len(points))
+    indices = np.zeros((len(coords), k), dtype=np.int)
+    distances = np.zeros((len(coords), k), dtype=np.int)
+    for start in xrange(0, len(coords), 1024):
+        chunk = coords[start:start+1024]
+        d = np.abs(chunk[:, np.newaxis, :] - points[np.newaxis, :, :]).sum(axis=2)
+        nearest = np.argsort(d, axis=1, kind="mergesort")[:, :k]
+        indices[start:start+len(chunk)] = nearest
+        distances[start:start+len(chunk)] = d[np.arange(len(chunk))[:, np.newaxis], nearest]
+
+    return indices, distances
+
+def candidate_points(coords, num_neighbours):
+    """
+    Returns the candidate Steiner points of the (n, 3) coordinates: for
+    each point and each pair of its num_neighbours nearest others, the
+    median of the three, which is where a rectilinear tree of the three
+    branches. (These are all points of the Hanan grid, but only
+    O(n * num_neighbours^2) of them.) Points of coords are left out.
+    """
+    neighbours, _ = nearest_neighbours(coords, coords, num_neighbours + 1)
+    # The nearest point to each is itself
+    neighbours = neighbours[:, 1:]
+
+    us, vs = np.triu_indices(neighbours.shape[1], 1)
+    triples = np.stack((np.repeat(coords[:, np.newaxis, :], len(us), axis=1),
+                        coords[neighbours[:, us]],
+                        coords[neighbours[:, vs]]))
+    candidates = np.median(triples, axis=0).astype(np.int).reshape(-1, 3)
+    candidates = np.unique(candidates, axis=0)
+
+    pins = set(map(tuple, coords.tolist()))
+    is_pin = np.array([tuple(c) in pins for c in candidates.tolist()], dtype=np.bool)
+    return candidates[~is_pin].reshape(-1, 3)
+
+def bottlenecks(size, tree, weights):
+    """
+    Returns the (size, size) matrix of the heaviest edge on the path
+    between each pair of nodes of the tree, whose edges (u, v) have the
+    given weights.
+
+    The edges are merged lightest first, as in Kruskal's algorithm: the
+    edge that joins two components is the heaviest on the path between
+    any node of one and any node of the other.
+    """
+    sets = DisjointSets(size)
+    members = [[u] for u in xrange(size)]
+    heaviest = np.zeros((size, size), dtype=np.int)
+    for k in np.argsort(weights, kind="mergesort").tolist():
+        u, v = sets.find(tree[k][0]), sets.find(tree[k][1])
+        heaviest[np.ix_(members[u], members[v])] = weights[k]
+        heaviest[np.ix_(members[v], members[u])] = weights[k]
+        sets.union(u, v)
+        root = sets.find(u)
+        members[root] = members[u] + members[v]
+
+    return heaviest
+
+def point_gain(neighbours, distances, heaviest):
+    """
+    Returns how much adding a point joined to the given neighbours (at
+    the given distances) shortens a tree whose heaviest path edges are
+    heaviest (see bottlenecks()).
+
+    The new tree drops, for each edge to the point it keeps, the heaviest
+    edge on the cycle that closes. That is the spanning tree of the
+    neighbours under the heaviest edges between them, less the spanning
+    tree of the neighbours and the point.
+    """
+    k = len(neighbours)
+    us, vs = np.triu_indices(k, 1)
+    between = heaviest[neighbours[us], neighbours[vs]].tolist()
+    us, vs = us.tolist(), vs.tolist()
+
+    _, without = kruskal(k, us, vs, between)
+    _, with_point = kruskal(k + 1, us + [k] * k, vs + list(xrange(k)), between + distances.tolist())
+    return without - with_point
+
+def tree_with_point(points, tree, point, num_neighbours):
+    """
+    Returns the minimum spanning tree of points plus point, and its
+    length, given the tree of points. Only the edges of the tree and those
+    from point to its num_neighbours nearest points can be in the new
+    tree.
+    """
+    m = len(points)
+    distances = np.abs(points - point).sum(axis=1)
+    nearest = np.argsort(distances, kind="mergesort")[:num_neighbours].tolist()
+
+    us = [u for u, _ in tree] + [m] * len(nearest)
+    vs = [v for _, v in tree] + nearest
+    weights = [int(w) for w in np.abs(points[us[:len(tree)]] - points[vs[:len(tree)]]).sum(axis=1)]
+    weights += distances[nearest].tolist()
+
+    return kruskal(m + 1, us, vs, weights)
+
+def prune(points, num_pins):
+    """
+    Remove the Steiner points (after the first num_pins points) with two
+    or fewer edges in the minimum spanning tree, which do not shorten it,
+    until there are none. Returns the points, their tree and its length.
+    """
+    while True:
+        tree, length = minimum_spanning_tree(points)
+        degrees = np.bincount(np.array(tree, dtype=np.int).reshape(-1), minlength=len(points))
+        keep = degrees > 2
+        keep[:num_pins] = True
+        if keep.all():
+            return points, tree, length
+        points = points[keep]
+
+def steiner_points(coords, blocked=None, num_neighbours=8, max_pins=500):
+    """
+    Find Steiner points that shorten the rectilinear minimum spanning tree
+    of the (n, 3) coordinates, with the batched iterated 1-Steiner
+    heuristic: every round, the candidates (see candidate_points()) are
+    ranked by how much each alone would shorten the tree, then added in
+    that order as long as each still shortens it.
+
+    Each candidate may only be joined to its num_neighbours nearest
+    points, so that ranking them takes O(n^2) for the tree's path
+    maxima and O(num_neighbours^2) per candidate. Nets of more than
+    max_pins pins are left as they are.
+
+    Candidates outside of blocked (a Boolean matrix) or where it is True
+    are skipped. Returns the Steiner points as an (m, 3) array.
+    """
+    coords = np.asarray(coords, dtype=np.int).reshape(-1, 3)
+    num_pins = len(coords)
+    if num_pins < 3 or num_pins > max_pins:
+        return np.zeros((0, 3), dtype=np.int)
+
+    candidates = candidate_points(coords, num_neighbours)
+    if blocked is not None:
+        inside = np.all((candidates >= 0) & (candidates < np.array(blocked.shape)), axis=1)
+        candidates = candidates[inside]
+        candidates = candidates[~blocked[tuple(candidates.T)]]
+
+    points = coords
+    tree, length = minimum_spanning_tree(points)
+
+    while len(candidates) > 0:
+        weights = [int(w) for w in np.abs(points[[u for u, _ in tree]] - points[[v for _, v in tree]]).sum(axis=1)]
+        heaviest = bottlenecks(len(points), tree, weights)
+        neighbours, distances = nearest_neighbours(points, candidates, num_neighbours)
+        gains = np.array([point_gain(n, d, heaviest) for n, d in zip(neighbours, distances)])
+
+        order = [k for k in np.argsort(-gains, kind="mergesort").tolist() if gains[k] > 0]
+        if not order:
+            break
+
+        for k in order:
+            new_tree, new_length = tree_with_point(points, tree, candidates[k], num_neighbours)
+            if new_length < length:
+                points = np.vstack((points, candidates[k]))
+                tree, length = new_tree, new_length
+
+        points, tree, length = prune(points, num_pins)
+
+        # The candidates ranked in this round are not tried again
+        used = np.zeros(len(candidates), dtype=np.bool)
+        used[order] = True
+        candidates = candidates[~used]
+
+    return points[num_pins:]
@@ -0,0 +1,108 @@
+from __future__ import print_function
+
+from collections import defaultdict
+
+import numpy as np
+
+from halo import HaloMap
+
+class UsageMap(object):
+    """
+    UsageMap tracks which locations of the layout are used, by the blocks
+    of the placed cells or by routed wires. Every location holds a count
+    of the wires that use it (plus one for a block), so that adding or
+    removing a wire only touches the wire's own locations.
+
+    matrix is the Boolean usage matrix (where the count is non-zero), and
+    halo is its HaloMap; both are kept up to date as wires are added and
+    removed.
+    """
+    def __init__(self, blocks):
+        self.shape = blocks.shape
+        self.matrix = blocks != 0
+        self.counts = self.matrix.astype(np.int16)
+        self.flat_counts = self.counts.reshape(-1)
+        self.halo = HaloMap(self.matrix)
+
+    def coordinates(self, indices):
+        """
+        Returns the (y, z, x) coordinates of the flat indices, as an (n, 3)
+        array.
+        """
+        return np.column_stack(np.unravel_index(indices, self.shape))
+
+    def add(self, wire):
+        """
+        Add a wire, given as unique flat indices into the layout. Returns
+        the indices that were not used before.
+        """
+        counts = self.flat_counts[wire]
+        self.flat_counts[wire] = counts + 1
+
+        added = wire[counts == 0]
+        np.put(self.matrix, added, True)
+        self.halo.add(self.coordinates(added))
+
+        return added
+
+    def remove(self, wire):
+        """
+        Remove a wire that was added with add(). Returns the indices that
+        are no longer used.
+        """
+        counts = self.flat_counts[wire] - 1
+        self.flat_counts[wire] = counts
+
+        removed = wire[counts == 0]
+        np.put(self.matrix, removed, False)
+        self.halo.remove(self.coordinates(removed))
+
+        return removed
+
+class ViolationIndex(object):
+    """
+    ViolationIndex keeps the number of violations of every routed segment
+    (the used locations among its violation indices) up to date.
+
+    It indexes each location by the segments whose violations cover it, so
+    that when locations become used or free, only those segments are
+    updated. Segments are identified by any hashable key, e.g. a
+    (net name, segment index) pair.
+    """
+    def __init__(self, usage):
+        self.usage = usage
+        self.covering = defaultdict(set)
+        self.counts = {}
+
+    def add_segment(self, key, violation):
+        """
+        Index the violation indices of a segment, and count its violations
+        against the current usage.
+        """
+        for i in violation.tolist():
+            self.covering[i].add(key)
+        self.counts[key] = np.count_nonzero(self.usage.matrix.take(violation))
+
+    def remove_segment(self, key, violation):
+        """
+        Remove a segment that was added with add_segment().
+        """
+        for i in violation.tolist():
+            keys = self.covering[i]
+            keys.discard(key)
+            if not keys:
+                del self.covering[i]
+        del self.counts[key]
+
+    def update(self, indices, delta):
+        """
+        Add delta to the violations of every segment covering each of the
+        indices, which have just become used (delta = 1) or free
+        (delta = -1).
+        """
+        counts = self.counts
+        covering = self.covering
+        for i in indices.tolist():
+            if i in covering:
+                for key in covering[i]:
+                    counts[key] += delta
@@ -5,6 +5,12 @@ import numpy as np
 from blocks import block_names
 from masked_subchunk import MaskedSubChunk
 
+# (dy, dz, dx) of one step in the direction a pin faces
+FACING_OFFSETS = {"north": (0, -1, 0),
+                  "west":  (0, 0, -1),
+                  "south": (0, 1, 0),
+                  "east":  (0, 0, 1)}
+
 class Cell(MaskedSubChunk):
     """
     A Cell represents a part of a circuit that computes the value of a
@@ -13,7 +19,20 @@ class Cell(MaskedSubChunk):
 
     ports is a dict that maps pin names to the (y, z, x) coordinates in
     the blocks matrix.
+
+    The geometry of the cell is precomputed, as read-only arrays, for the
+    placer and router:
+
+    - shape: the (height, width, length) of the blocks matrix
+    - footprint: where the blocks are not air
+    - port_names: the pin names, sorted, which index the port arrays
+    - port_offsets: the (y, z, x) coordinates of each port
+    - port_facings: the (dy, dz, dx) step in the direction each port faces
+    - port_outputs: whether each port is an output
     """
+    __slots__ = ("name", "ports", "delay", "shape", "footprint",
+                 "port_names", "port_offsets", "port_facings", "port_outputs")
+
     def __init__(self, blocks, data, mask, name, ports, delay):
         super(Cell, self).__init__(blocks, data, mask)
 
@@ -21,6 +40,24 @@ class Cell(MaskedSubChunk):
         self.ports = ports
         self.delay = delay
 
+        self.compute_geometry()
+
+    def compute_geometry(self):
+        """
+        Precompute the shape, footprint and port arrays of the cell.
+        """
+        self.shape = self.blocks.shape
+        self.footprint = self.blocks > 0
+
+        self.port_names = sorted(self.ports)
+        ports = [self.ports[pin] for pin in self.port_names]
+        self.port_offsets = np.array([d["coordinates"] for d in ports], dtype=np.int32).reshape(-1, 3)
+        self.port_facings = np.array([FACING_OFFSETS[d["facing"]] for d in ports], dtype=np.int32).reshape(-1, 3)
+        self.port_outputs = np.array([d["direction"] == "output" for d in ports], dtype=np.bool)
+
+        for array in (self.footprint, self.port_offsets, self.port_facings, self.port_outputs):
+            array.setflags(write=False)
+
     def rot90(self, turns=1):
         """
         Rotates the cell and its ports in the counter-clockwise direction (As numpy
@@ -31,7 +68,7 @@ class Cell(MaskedSubChunk):
         facing_arr = ["east", "north", "west", "south"]
 
         # Rotate the ports
-        height, width, length = self.blocks.shape
+        height, width, length = self.shape
         new_ports = {}
         for pin, d in self.ports.iteritems():
             (y, z, x) = d["coordinates"]
@@ -15,6 +15,8 @@ class MaskedSubChunk(object):
 
     Dimensions are organized (Y, Z, X).
     """
+    __slots__ = ("blocks", "data", "mask")
+
     def __init__(self, blocks, data, mask):
         blocks = np.asarray(blocks, dtype=np.uint8)
         data = np.asarray(data, dtype=np.uint8)